@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks of the label processing pipeline
+
+import argparse
+import io
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from PIL import Image
+
+import numpy as np
+
+import ptcbp
+from labelfont import fit_font_size
+from labelmaker_encode import encode_raster_transfer
+from printlabel import (
+    HEIGHT_OF_THE_PRINTABLE_AREA, convert_image, find_content_box, fit_text,
+    process_image, render_label, set_args
+)
+from pttransfer import FrameWriter
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """ Register a benchmark function under the given name """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def best_time(func, repeat, *args):
+    """ Run func(*args) repeat times and return the fastest run in seconds """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def load_greyscale(path):
+    """ Load an image (or the first page of a PDF) as process_image() does """
+    if path.lower().endswith('.pdf'):
+        from pdf2image import convert_from_path
+        img = convert_from_path(path, dpi=300, first_page=1, last_page=1)[0]
+    else:
+        img = Image.open(path)
+    img = img.convert("RGBA")
+    white_background = Image.new("RGBA", img.size, (255, 255, 255, 255))
+    white_background.paste(img, (0, 0), img)
+    return white_background.convert("L")
+
+
+def find_content_box_loop(img, white_level):
+    """ Reference per-pixel implementation of find_content_box() """
+    width, height = img.size
+    left, top, right, bottom = width, height, 0, 0
+    for y in range(height):
+        for x in range(width):
+            if img.getpixel((x, y)) < white_level:
+                left = min(left, x)
+                right = max(right, x)
+                top = min(top, y)
+                bottom = max(bottom, y)
+    if right > left and bottom > top:
+        return left, top, right + 1, bottom + 1
+    return None
+
+
+@benchmark('crop')
+def bench_crop(args):
+    img = load_greyscale(args.image)
+    box = find_content_box(img, args.white_level)
+    if box != find_content_box_loop(img, args.white_level):
+        raise RuntimeError('find_content_box() differs from the reference')
+    loop = best_time(find_content_box_loop, 1, img, args.white_level)
+    fast = best_time(find_content_box, args.repeat, img, args.white_level)
+    return {
+        'image': args.image,
+        'size': '%dx%d' % img.size,
+        'box': box,
+        'loop_s': loop,
+        'fast_s': fast,
+        'speedup': loop / fast,
+    }
+
+
+def make_raster(lines, seed=0):
+    """ Build a reproducible 1bpp raster mixing blank, text-like and noisy lines """
+    rng = random.Random(seed)
+    data = bytearray()
+    for _ in range(lines):
+        kind = rng.random()
+        if kind < 0.3:
+            data += bytes(16)
+        elif kind < 0.8:
+            # Glyph strokes: a few runs of black dots in the printable area
+            line = bytearray(16)
+            for _ in range(rng.randint(1, 4)):
+                start = rng.randint(3, 12)
+                for i in range(start, min(start + rng.randint(1, 3), 13)):
+                    line[i] = 0xff
+            data += line
+        else:
+            data += bytes(rng.getrandbits(8) for _ in range(16))
+    return bytes(data)
+
+
+def encode_raster_reference(data, compress):
+    """ Reference per-line Opcode implementation of ptcbp.serialize_raster() """
+    zero_line = bytes(16)
+    out = []
+    for i in range(0, len(data), 16):
+        chunk = data[i : i + 16]
+        if chunk == zero_line:
+            out.append(ptcbp.serialize_control('zerofill'))
+        else:
+            out.append(ptcbp.serialize_data(chunk, compress))
+    return b''.join(out)
+
+
+def serialize_raster_cold(data, compress):
+    """ ptcbp.serialize_raster() with an empty raster line cache """
+    ptcbp._encode_line.cache_clear()
+    return ptcbp.serialize_raster(data, compress)
+
+
+@benchmark('encode')
+def bench_encode(args):
+    data = make_raster(args.lines, args.seed)
+    result = {'lines': args.lines}
+    for compress in ('rle', 'none'):
+        if serialize_raster_cold(data, compress) != encode_raster_reference(data, compress):
+            raise RuntimeError(f'serialize_raster() differs from the reference ({compress})')
+        reference = best_time(encode_raster_reference, args.repeat, data, compress)
+        cold = best_time(serialize_raster_cold, args.repeat, data, compress)
+        warm = best_time(ptcbp.serialize_raster, args.repeat, data, compress)
+        result[f'{compress}_reference_lines_per_s'] = args.lines / reference
+        result[f'{compress}_cold_lines_per_s'] = args.lines / cold
+        result[f'{compress}_warm_lines_per_s'] = args.lines / warm
+        result[f'{compress}_speedup'] = reference / cold
+    serialize_raster_cold(data, 'rle')
+    cache = ptcbp.raster_cache_info()
+    result['rle_cache_hit_rate'] = cache.hits / (cache.hits + cache.misses)
+    return result
+
+
+# Labels used by the rendering benchmarks: (TEXT_TO_PRINT, extra options)
+RENDER_CORPUS = (
+    ('Hello World', []),
+    ('RACK-42 U17', []),
+    ('lorem ipsum dolor', ['--text-size', '40']),
+    ('Line one|Line two', ['--multiline']),
+    ('A-1|B-22|C-333', ['--multiline', '--align', 'left']),
+    ('Bold', ['--stroke-width', '1']),
+)
+
+
+def render(p, argv):
+    """ Render a label with printlabel options; return the 1bpp raster data """
+    args = p.parse_args(argv)
+    return convert_image(args, render_label(p, args, ' '.join(args.text_to_print)))
+
+
+@benchmark('render')
+def bench_render(args):
+    p = set_args()
+    result = {'font': args.font}
+    references = {}
+    for scale in (4, 2, 1):
+        seconds, diff_dots, total_dots = 0.0, 0, 0
+        for text, options in RENDER_CORPUS:
+            argv = ['X', args.font, text, '--scale-factor', str(scale)] + options
+            seconds += best_time(render, args.repeat, p, argv)
+            data = np.unpackbits(np.frombuffer(render(p, argv), dtype=np.uint8))
+            reference = references.setdefault(text, data)
+            if len(data) == len(reference):
+                diff_dots += int(np.count_nonzero(data != reference))
+            else:  # Different length: count the whole label as different
+                diff_dots += max(len(data), len(reference))
+            total_dots += int(np.count_nonzero(reference))
+        result[f'scale_{scale}_s'] = seconds
+        result[f'scale_{scale}_speedup'] = result['scale_4_s'] / seconds
+        # Dots differing from the 4x rendering, relative to its black dots
+        result[f'scale_{scale}_diff'] = diff_dots / total_dots
+    return result
+
+
+# Labels of the stage benchmark: name -> (TEXT_TO_PRINT, extra options);
+# IMAGE is replaced by the --image option
+STAGE_CORPUS = {
+    'single': ('Hello World', []),
+    'multiline': ('Line one|Line two|Line three', ['--multiline']),
+    'text_size': ('lorem ipsum dolor', ['--text-size', '40']),
+    'merge': ('Hello!', ['-M', 'IMAGE']),
+    'long': ('Long label text ' * 6, ['-l']),
+}
+
+
+class NullSerial(object):
+    """ Serial port discarding the written data """
+    def write(self, data):
+        return len(data)
+
+
+def fit_cold(p, args, text):
+    fit_font_size.cache_clear()
+    return fit_text(p, args, text)
+
+
+def encode_cold(data):
+    ptcbp._encode_line.cache_clear()
+    return b''.join(encode_raster_transfer(data))
+
+
+def deserialize_all(stream, compress):
+    buf = io.BytesIO(stream)
+    ops = 0
+    while ptcbp.Opcode.deserialize(buf, compress) is not None:
+        ops += 1
+    return ops
+
+
+def iter_commands_all(stream, compress):
+    ops = 0
+    for command in ptcbp.iter_commands(stream):
+        command.data(compress)
+        ops += 1
+    return ops
+
+
+def send(stream, frame_size):
+    writer = FrameWriter(NullSerial(), frame_size)
+    for i in range(0, len(stream), 19):
+        writer.write(stream[i:i + 19])
+    writer.flush()
+    return writer.stats.bytes
+
+
+@benchmark('stages')
+def bench_stages(args):
+    """ Time each stage of printing the labels of STAGE_CORPUS """
+    p = set_args()
+    result = {}
+    for name, (text, options) in STAGE_CORPUS.items():
+        options = [args.image if o == 'IMAGE' else o for o in options]
+        label_args = p.parse_args(['X', args.font, text, '--no-cache'] + options)
+        image = render_label(p, label_args, text)
+        data = convert_image(label_args, image)
+        stream = encode_cold(data)
+        stages = {
+            'lines': len(data) // 16,
+            'fit_s': best_time(fit_cold, args.repeat, p, label_args, text),
+        }
+        if label_args.merge:
+            stages['process_image_s'] = best_time(
+                process_image, args.repeat, label_args.merge[0], label_args.resize,
+                label_args.white_level, HEIGHT_OF_THE_PRINTABLE_AREA
+            )
+        stages['render_s'] = best_time(render_label, args.repeat, p, label_args, text)
+        stages['convert_s'] = best_time(convert_image, args.repeat, label_args, image)
+        stages['encode_s'] = best_time(encode_cold, args.repeat, data)
+        stages['encoded_bytes'] = len(stream)
+        stages['deserialize_s'] = best_time(deserialize_all, args.repeat, stream, 'rle')
+        stages['iter_commands_s'] = best_time(iter_commands_all, args.repeat, stream, 'rle')
+        stages['send_s'] = best_time(send, args.repeat, stream, args.frame_size)
+        # Time to transfer the data over the Bluetooth link
+        stages['link_s'] = len(stream) / args.bandwidth
+        result[name] = stages
+    return result
+
+
+def git_revision():
+    """ Return the current commit of the working tree, if any """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('benchmarks', metavar='BENCHMARK', nargs='*',
+                   help='Benchmarks to run (default: all). Available: '
+                   + ', '.join(BENCHMARKS))
+    p.add_argument('--image', default='happy-sun.pdf',
+                   help='Image or PDF used by the image benchmarks (default: happy-sun.pdf).')
+    p.add_argument('--font', default='arial.ttf',
+                   help='Font used by the rendering benchmarks (default: arial.ttf).')
+    p.add_argument('--white-level', type=int, default=240,
+                   help='White level used when cropping (default: 240).')
+    p.add_argument('--lines', type=int, default=3000,
+                   help='Number of raster lines of the encoding benchmarks (default: 3000).')
+    p.add_argument('--seed', type=int, default=0,
+                   help='Seed of the generated raster data (default: 0).')
+    p.add_argument('--repeat', type=int, default=5,
+                   help='Number of runs; the fastest one is reported (default: 5).')
+    p.add_argument('--frame-size', type=int, default=990,
+                   help='Size of the serial writes of the stage benchmark (default: 990).')
+    p.add_argument('--bandwidth', type=int, default=20000,
+                   help='Bytes per second of the simulated Bluetooth link (default: 20000).')
+    p.add_argument('--json', metavar='FILE_NAME',
+                   help='Write the results to a JSON file ("-" = stdout), to compare runs'
+                   ' between commits.')
+    return p, p.parse_args()
+
+
+def print_result(result, indent='  '):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            print(f'{indent}{key}:')
+            print_result(value, indent + '  ')
+            continue
+        if isinstance(value, float):
+            value = '%.6f' % value
+        print(f'{indent}{key}: {value}')
+
+
+def main():
+    p, args = parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            p.error(f'Unknown benchmark "{name}"')
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results[name] = BENCHMARKS[name](args)
+        if args.json != '-':
+            print(f'=> {name}')
+            print_result(results[name])
+    if args.json:
+        report = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {k: v for k, v in vars(args).items() if k not in ('benchmarks', 'json')},
+            'benchmarks': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
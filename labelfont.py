@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Font loading, font size fitting and glyph cache for printlabel
+
+import functools
+import unicodedata
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+# Number of parsed fonts kept in memory (one entry per path and size)
+FONT_CACHE_SIZE = 64
+
+# Number of font sizes fitted to a text kept in memory
+FIT_CACHE_SIZE = 256
+
+# Number of rendered glyphs kept in memory (one entry per font, size,
+# stroke width and character)
+GLYPH_CACHE_SIZE = 4096
+
+# Bidirectional classes of the characters drawn from the glyph cache;
+# right-to-left and combining characters need the full text layout
+SIMPLE_BIDI_CLASSES = {'L', 'EN', 'ES', 'ET', 'CS', 'ON', 'WS'}
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(path, size):
+    """ Load a TrueType/OpenType font, reusing an already parsed one if possible """
+    return ImageFont.truetype(path, size, encoding='utf-8')
+
+
+def measure_lines(font, lines):
+    """ Return the maximum width and height of the lines drawn with the font """
+    max_width, max_height = 0, 0
+    for line in lines:
+        bbox = font.getbbox(line, anchor="lt")
+        max_width = max(max_width, bbox[2])
+        max_height = max(max_height, bbox[3])
+    return max_width, max_height
+
+
+@functools.lru_cache(maxsize=FIT_CACHE_SIZE)
+def fit_font_size(path, lines, max_height, max_width=None):
+    """ Find the largest font size where all lines (a tuple) fit the given area
+
+    The size is bracketed by doubling it until the text no longer fits, then
+    refined with a binary search, so only a handful of sizes are measured.
+    Returns a (font_size, text_width) tuple.
+    """
+    def measure(size):
+        width, height = measure_lines(get_font(path, size), lines)
+        fits = height <= max_height and not (max_width and width > max_width)
+        return fits, width
+
+    fits, width = measure(1)
+    if not fits:
+        raise ValueError('the text does not fit the printable area')
+
+    # Bracket: good always fits, bad never fits
+    good, good_width = 1, width
+    bad = 2
+    while True:
+        fits, width = measure(bad)
+        if not fits:
+            break
+        good, good_width = bad, width
+        bad *= 2
+
+    # Binary search within the bracket
+    while bad - good > 1:
+        size = (good + bad) // 2
+        fits, width = measure(size)
+        if fits:
+            good, good_width = size, width
+        else:
+            bad = size
+
+    return good, good_width
+
+
+@functools.lru_cache(maxsize=GLYPH_CACHE_SIZE)
+def get_glyph(path, size, stroke_width, char):
+    """ Render a character to a greyscale mask
+
+    Returns the mask, the (x, y) offset of the mask from the left end of the
+    baseline of the character and the advance width of the character.
+    """
+    font = get_font(path, size)
+    left, top, right, bottom = font.getbbox(char, anchor="ls", stroke_width=stroke_width)
+    mask = Image.new("L", (max(right - left, 0), max(bottom - top, 0)), 0)
+    if mask.width and mask.height:
+        ImageDraw.Draw(mask).text(
+            (-left, -top), char, font=font, fill=255, anchor="ls",
+            stroke_width=stroke_width
+        )
+    return mask, (left, top), font.getlength(char)
+
+
+def is_glyph_cacheable(font, text):
+    """ Check whether the text can be drawn glyph by glyph
+
+    Complex scripts, combining characters and kerned pairs change the
+    position or the shape of the glyphs with respect to their neighbours.
+    """
+    for char in text:
+        if (not char.isprintable() or unicodedata.combining(char)
+                or unicodedata.bidirectional(char) not in SIMPLE_BIDI_CLASSES):
+            return False
+    # Kerning (or any other layout adjustment) changes the advances
+    return font.getlength(text) == sum(font.getlength(char) for char in text)
+
+
+def draw_text(image, xy, text, path, size, fill, stroke_width=0, stroke_fill=None):
+    """ Draw a line of text with "lt" anchor, blitting cached glyphs
+
+    Equivalent to ImageDraw.text(), which is used as a fallback for the
+    texts that cannot be drawn glyph by glyph. Glyphs are placed at whole
+    pixels: with fractional coordinates, their position can differ from
+    ImageDraw.text() by less than one pixel.
+    """
+    font = get_font(path, size)
+    if not is_glyph_cacheable(font, text):
+        ImageDraw.Draw(image).text(
+            xy, text, font=font, fill=fill, anchor="lt",
+            stroke_width=stroke_width, stroke_fill=stroke_fill
+        )
+        return
+
+    # Same passes as ImageDraw.text(): the stroke first, then the text
+    # over it when it has a different color
+    passes = [(fill, 0)]
+    if stroke_width:
+        passes = [(fill if stroke_fill is None else stroke_fill, stroke_width)]
+        if stroke_fill is not None and ImageColor.getrgb(stroke_fill) != ImageColor.getrgb(fill):
+            passes.append((fill, 0))
+
+    # The "lt" anchor is at the top of the highest glyph of the line
+    baseline = xy[1] - font.getbbox(text, anchor="ls")[1]
+    for ink, width in passes:
+        x = xy[0]
+        for char in text:
+            mask, (dx, dy), advance = get_glyph(path, size, width, char)
+            if mask.width and mask.height:
+                left, top = round(x) + dx, round(baseline) + dy
+                image.paste(ink, (left, top, left + mask.width, top + mask.height), mask)
+            x += advance
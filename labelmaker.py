@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
-from labelmaker_encode import encode_raster_transfer, read_png
+from labelmaker_encode import EncodedPages, read_png
+from pttiming import TIMER, profiling, stage, timed
+from ptreplay import CaptureFile, is_capture
+from pttransfer import DEFAULT_FRAME_SIZE, FrameWriter
 
 import argparse
 import sys
@@ -9,6 +12,10 @@ import ctypes
 import ptcbp
 import ptstatus
 import serial
+from ptstatus import (
+    READY_TIMEOUT, STATUS_TIMEOUT, is_ready, print_deadline, start_printing, wait_for_printed,
+    wait_for_ready
+)
 
 BARS = '123456789'
 
@@ -22,8 +29,29 @@ def parse_args():
     p.add_argument('-m', '--end-margin', help='End margin (in dots).', default=0, type=int)
     p.add_argument('-r', '--raw', help='Send the image to printer as-is without any pre-processing.', action='store_true')
     p.add_argument('-C', '--nocomp', help='Disable compression.', action='store_true')
+    p.add_argument('-w', '--wait', help='Wait for the end of the printing and fail if it does not complete in the expected time.', action='store_true')
+    p.add_argument('--frame-size', help=f'Size of the serial writes (in bytes, default: {DEFAULT_FRAME_SIZE}).', default=DEFAULT_FRAME_SIZE, type=int)
+    p.add_argument('--timing', action='store_true', help='Show the time spent in each stage on the standard error.')
+    p.add_argument('--timing-format', choices=['summary', 'json'], default='summary', help='Format of --timing: a summary table (default) or JSON lines.')
+    p.add_argument('--profile', metavar='FILE_NAME', help='Profile the run with cProfile and write the stats to FILE_NAME.')
     return p, p.parse_args()
 
+def ratio(encoded_bytes, raw_bytes):
+    """ Describe the size of the encoded image data compared to the raw one """
+    percent = 100 * encoded_bytes / raw_bytes if raw_bytes else 0
+    return f"{percent:.1f}% of the {raw_bytes} bytes of raw raster data"
+
+def show_progress(lines):
+    """ Draw a progress bar character for each line, showing its size """
+    bar = []
+    for line in lines:
+        if line[0:1] == b'G':
+            bar.append(BARS[min((len(line) - 3) // 2, 7) + 1])
+        elif line[0:1] == b'Z':
+            bar.append(BARS[0])
+    sys.stdout.write(''.join(bar))
+    sys.stdout.flush()
+
 def reset_printer(ser):
     # Flush print buffer
     ser.write(b"\x00" * 64)
@@ -34,8 +62,9 @@ def reset_printer(ser):
     # Enter raster graphics (PTCBP) mode
     ser.write(ptcbp.serialize_control('use_command_set', ptcbp.CommandSet.ptcbp))
 
-def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, end_margin=0):
-    reset_printer(ser)
+def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False, auto_cut=False, end_margin=0, reset=True, follow_up=False):
+    if reset:
+        reset_printer(ser)
 
     type_, width, length = tape_dim
     # Set media & quality
@@ -47,7 +76,7 @@ def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False
         width_mm=width, # Tape width in mm
         length_mm=length, # Label height in mm (0 for continuous roll)
         length_px=raster_lines, # Number of raster lines in image data
-        is_follow_up=0, # Unused
+        is_follow_up=1 if follow_up else 0, # 0 for the first page of a job
         sbz=0, # Unused
     )))
 
@@ -69,70 +98,154 @@ def configure_printer(ser, raster_lines, tape_dim, compress=True, chaining=False
     # Set compression mode: TIFF
     ser.write(ptcbp.serialize_control('compression', ptcbp.CompressionType.rle if compress else ptcbp.CompressionType.none))
 
-def do_print_job(ser, args, data):
+def do_print_job(ser, args, data, reset=True):
+    return do_print_pages(ser, args, [data], reset=reset)
+
+@timed('print_job')
+def do_print_pages(ser, args, pages, reset=True, prefix=None, continuous=False, ready_timeout=READY_TIMEOUT):
+    """ Print one or more pages (labels) chained in a single print job
+
+    Pages are separated by a print_page command, so the tape header is fed
+    once; with auto-cut, the tape is only cut after the last page. prefix
+    (a RasterPrefix) holds the pre-encoded lines the pages start with.
+    pages can also be EncodedPages, e.g. encoded in advance. With
+    continuous, the pages are the segments of a single label, chained
+    without any margin between them.
+
+    Waits up to ready_timeout seconds for the printer to finish a previous
+    job. With args.wait, also waits for the end of the printing. Returns
+    the time.monotonic() by which the printing must be completed, or None
+    if nothing was printed.
+    """
+    if not isinstance(pages, EncodedPages):
+        # Each page is encoded with the compression sending fewer bytes
+        pages = EncodedPages(pages, args.nocomp, prefix)
+
     print('=> Querying printer status...')
 
-    reset_printer(ser)
+    if reset:
+        reset_printer(ser)
 
-    # Dump status
-    ser.write(ptcbp.serialize_control('get_status'))
-    status = ptstatus.unpack_status(ser.read(32))
+    # Dump status, once the printer is done with a previous job
+    status = wait_for_ready(ser, ready_timeout)
+    if status is None:
+        print('** Printer does not reply. Refusing to continue.')
+        sys.exit(1)
     ptstatus.print_status(status)
 
-    if status.err != 0x0000 or status.phase_type != 0x00 or status.phase != 0x0000:
+    if not is_ready(status):
         print('** Printer indicates that it is not ready. Refusing to continue.')
         sys.exit(1)
 
-    print('=> Configuring printer...')
-
-    raster_lines = len(data) // 16
-    configure_printer(ser, raster_lines, (status.tape_type,
-                                          status.tape_width,
-                                          status.tape_length),
-                      chaining=args.no_feed,
-                      auto_cut=args.auto_cut,
-                      end_margin=args.end_margin,
-                      compress=not args.nocomp)
-
-    # Send image data
-    print(f"=> Sending image data ({raster_lines} lines)...")
-    sys.stdout.write('[')
-    for line in encode_raster_transfer(data, args.nocomp):
-        if line[0:1] == b'G':
-            sys.stdout.write(BARS[min((len(line) - 3) // 2, 7) + 1])
-        elif line[0:1] == b'Z':
-            sys.stdout.write(BARS[0])
-        sys.stdout.flush()
-        ser.write(line)
-    sys.stdout.write(']')
+    raw_bytes, encoded_bytes = 0, 0
+    for page, (data, compress, commands) in enumerate(pages, 1):
+        last_page = page == len(pages)
+
+        raw_bytes += len(data)
+
+        print('=> Configuring printer...')
 
-    print()
+        raster_lines = len(data) // 16
+        configure_printer(ser, raster_lines, (status.tape_type,
+                                              status.tape_width,
+                                              status.tape_length),
+                          chaining=args.no_feed or (continuous and not last_page),
+                          auto_cut=args.auto_cut and last_page,
+                          end_margin=args.end_margin if last_page or not continuous else 0,
+                          compress=compress == 'rle',
+                          reset=reset and page == 1,
+                          follow_up=page > 1)
+
+        # Send image data
+        if len(pages) > 1:
+            print(f"=> Sending page {page}/{len(pages)} ({raster_lines} lines)...")
+        else:
+            print(f"=> Sending image data ({raster_lines} lines)...")
+        sys.stdout.write('[')
+        writer = FrameWriter(ser,
+                             frame_size=getattr(args, 'frame_size', None) or DEFAULT_FRAME_SIZE,
+                             progress=show_progress)
+        with stage('send'):
+            for line in commands:
+                writer.write_line(line)
+            writer.flush()
+        sys.stdout.write(']')
+        encoded_bytes += writer.stats.bytes
+
+        print()
+        print(f"=> Sent {writer.stats}")
+        print(f"=> Compression: {compress}, {ratio(writer.stats.bytes, len(data))}")
+
+        if not last_page and not args.no_print:
+            # Print the page without feeding, the next one follows
+            ser.write(ptcbp.serialize_control('print_page'))
+
+    if len(pages) > 1:
+        print(f"=> Job image data: {encoded_bytes} bytes, {ratio(encoded_bytes, raw_bytes)}")
+    lookups = pages.cache_hits + pages.cache_misses
+    print(f"=> Raster line cache: {pages.cache_hits} hits, {pages.cache_misses} misses"
+          f" ({100 * pages.cache_hits / lookups if lookups else 0:.1f}% hit rate,"
+          f" {ptcbp.raster_cache_info().currsize} lines cached)")
     print("=> Image data was sent successfully. Printing will begin soon.")
 
-    if not args.no_print:
-        # Print and feed
-        ser.write(ptcbp.serialize_control('print'))
+    if args.no_print:
+        print("=> All done.")
+        return None
+
+    # Print and feed
+    status = start_printing(ser)
+    if status is None:
+        print('** Printer did not acknowledge the print command.')
+        sys.exit(1)
+    deadline = print_deadline(raw_bytes // 16)
+
+    # Dump status that the printer returns
+    ptstatus.print_status(status)
 
-        # Dump status that the printer returns
-        status = ptstatus.unpack_status(ser.read(32))
-        ptstatus.print_status(status)
+    if getattr(args, 'wait', False):
+        print('=> Waiting for the end of the printing...')
+        status = wait_for_printed(ser, status, deadline)
+        if status is None or not is_ready(status):
+            if status is not None:
+                ptstatus.print_status(status)
+            print('** Printing did not complete.')
+            sys.exit(1)
+        print('=> Printing completed.')
 
     print("=> All done.")
+    return deadline
 
 def main():
     p, args = parse_args()
+    try:
+        with profiling(args.profile):
+            run(p, args)
+    finally:
+        if args.timing:
+            TIMER.report(args.timing_format)
 
+def run(p, args):
     data = None
     if args.image is None:
         p.error('An image must be specified for printing job.')
     else:
         # Read input image into memory
-        if args.raw:
-            data = read_png(args.image, False, False, False)
-        else:
-            data = read_png(args.image)
+        with stage('read_png'):
+            if args.raw:
+                data = read_png(args.image, False, False, False)
+            else:
+                data = read_png(args.image)
+
+    # Imported here as the spooler itself is built on this module
+    from printspool import is_spooler, submit_job
+    if is_spooler(args.comport):
+        sys.exit(submit_job(args.comport, args, [data]))
 
-    ser = serial.Serial(args.comport)
+    if is_capture(args.comport):
+        # Write the commands to a file, printed later by ptreplay.py
+        ser = CaptureFile(args.comport)
+    else:
+        ser = serial.Serial(args.comport, timeout=STATUS_TIMEOUT)
 
     try:
         assert data is not None
@@ -140,6 +253,7 @@ def main():
     finally:
         # Initialize
         reset_printer(ser)
+        ser.close()
 
 if __name__ == '__main__':
     main()
@@ -1,20 +1,150 @@
+import itertools
 import ptcbp
-from PIL import Image, ImageOps
-from io import BytesIO
+import numpy as np
+from PIL import Image
+from ptraster import to_raster
+from pttiming import timed
 
 def encode_raster_transfer(data, nocomp=False):
     """ Encode 1 bit per pixel image data for transfer over serial to the printer """
     # Send in chunks of 1 line (128px @ 1bpp = 16 bytes)
     # This mirrors the official app from Brother. Other values haven't been tested.
-    chunk_size = 16
-    zero_line = bytearray(b'\x00' * chunk_size)
+    return ptcbp.iter_raster(data, 'none' if nocomp else 'rle', ptcbp.RASTER_LINE_SIZE)
 
-    for i in range(0, len(data), chunk_size):
-        chunk = data[i : i + chunk_size]
-        if chunk == zero_line:
-            yield ptcbp.serialize_control('zerofill')
+class RasterPrefix(object):
+    """ Raster lines starting several pages (e.g. the static part of a
+    label template), encoded once with each compression """
+    def __init__(self, data, nocomp=False):
+        if len(data) % ptcbp.RASTER_LINE_SIZE:
+            raise ValueError('Prefix data must be made of whole raster lines')
+        self.data = data
+        self.commands = {
+            compress: list(ptcbp.iter_raster(data, compress, ptcbp.RASTER_LINE_SIZE))
+            for compress in (['none'] if nocomp else ['rle', 'none'])
+        }
+
+@timed('encode')
+def encode_raster_page(data, nocomp=False, prefix=None):
+    """ Encode a page with the compression which sends fewer bytes
+
+    The printer takes a single compression mode per page (set by the
+    'compression' command before the raster data), so RLE and no
+    compression are compared over the whole page. PackBits can expand
+    noisy lines (dithered photos, QR codes) beyond their 16 raw bytes.
+    When the page starts with the lines of prefix (a RasterPrefix), their
+    pre-encoded commands are reused.
+    Returns the compression name and the list of line commands.
+    """
+    candidates = ['none'] if nocomp else ['rle', 'none']
+    if prefix is not None and not data.startswith(prefix.data):
+        prefix = None
+    best = None
+    for compress in candidates:
+        if prefix is not None and compress in prefix.commands:
+            commands = prefix.commands[compress] + list(ptcbp.iter_raster(
+                data[len(prefix.data):], compress, ptcbp.RASTER_LINE_SIZE))
         else:
-            yield ptcbp.serialize_data(chunk, 'none' if nocomp else 'rle')
+            commands = list(ptcbp.iter_raster(data, compress, ptcbp.RASTER_LINE_SIZE))
+        size = sum(len(c) for c in commands)
+        if best is None or size < best[2]:
+            best = (compress, commands, size)
+    return best[0], best[1]
+
+class RasterStream(object):
+    """ Raster data of a page produced in chunks of whole lines (e.g. a
+    label rendered in strips), with a known number of lines. Iterating
+    yields the chunks, once. """
+    def __init__(self, lines, chunks):
+        self.lines = lines
+        self.chunks = chunks
+
+    def __len__(self):
+        return self.lines * ptcbp.RASTER_LINE_SIZE
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __bytes__(self):
+        return b''.join(self.chunks)
+
+    def split(self, max_lines):
+        """ Split into streams of at most max_lines lines, which must be
+        iterated over in order """
+        chunks = iter(self.chunks)
+        pending = b''
+
+        def segment(lines):
+            nonlocal pending
+            size = lines * ptcbp.RASTER_LINE_SIZE
+            while size:
+                if not pending:
+                    pending = next(chunks)
+                chunk, pending = pending[:size], pending[size:]
+                size -= len(chunk)
+                yield chunk
+
+        segments = []
+        for start in range(0, self.lines, max_lines):
+            lines = min(max_lines, self.lines - start)
+            segments.append(RasterStream(lines, segment(lines)))
+        return segments
+
+def split_page(data, max_lines):
+    """ Split the raster data of a page (bytes or RasterStream) into
+    segments of at most max_lines lines """
+    if len(data) <= max_lines * ptcbp.RASTER_LINE_SIZE:
+        return [data]
+    if isinstance(data, RasterStream):
+        return data.split(max_lines)
+    size = max_lines * ptcbp.RASTER_LINE_SIZE
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+class EncodedPages(object):
+    """ Pages of a print job, encoded with encode_raster_page() as they are
+    iterated over, or all at once by encode_all() (e.g. while the printer
+    is still busy with the previous job). Iterating yields the (data,
+    compression, commands) tuple of each page; the commands of a
+    RasterStream page are encoded while they are sent. Once all the pages
+    are encoded, cache_hits and cache_misses count the lookups of the
+    raster line cache made for them. """
+    def __init__(self, pages, nocomp=False, prefix=None):
+        self.pages = pages
+        self.nocomp = nocomp
+        self.prefix = prefix
+        self.cache_hits = self.cache_misses = 0
+        self._encoded = None
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        if self._encoded is not None:
+            return iter(self._encoded)
+        return self._encode()
+
+    def _encode(self):
+        # The cache lives as long as the process (e.g. the print spooler):
+        # only count the lookups made while encoding these pages
+        start = ptcbp.raster_cache_info()
+        for data in self.pages:
+            if isinstance(data, RasterStream):
+                # The lines are encoded as they are produced: the page
+                # cannot be compared with both compressions beforehand
+                compress = 'none' if self.nocomp else 'rle'
+                commands = itertools.chain.from_iterable(
+                    ptcbp.iter_raster(chunk, compress, ptcbp.RASTER_LINE_SIZE)
+                    for chunk in data)
+            else:
+                compress, commands = encode_raster_page(data, self.nocomp, self.prefix)
+            yield data, compress, commands
+        end = ptcbp.raster_cache_info()
+        self.cache_hits = end.hits - start.hits
+        self.cache_misses = end.misses - start.misses
+
+    def encode_all(self):
+        if self._encoded is None:
+            self._encoded = list(self._encode())
+        return self
 
 def read_png(path, transform=True, padding=True, dither=True):
     """ Read a image and convert to 1bpp raw data
@@ -24,15 +154,6 @@ def read_png(path, transform=True, padding=True, dither=True):
     """
     image = Image.open(path)
     tmp = image.convert('1', dither=Image.FLOYDSTEINBERG if dither else Image.NONE)
-    tmp = ImageOps.invert(tmp.convert('L')).convert('1')
-    if transform:
-        tmp = tmp.rotate(-90, expand=True)
-        tmp = ImageOps.mirror(tmp)
-    if padding:
-        w, h = tmp.size
-        padded = Image.new('1', (128, h))
-        x, y = (128-w)//2, 0
-        nw, nh = x+w, y+h
-        padded.paste(tmp, (x, y, nw, nh))
-        tmp = padded
-    return tmp.tobytes()
+    # Black pixels are the dots to print
+    dots = ~np.asarray(tmp)
+    return to_raster(dots, transform, padding)
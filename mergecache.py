@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Content-addressed cache of processed merge images
+
+import hashlib
+import os
+from collections import OrderedDict
+
+from PIL import Image
+
+# Bump when the processing of merged images changes, to invalidate old entries
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    """ Return the per-user directory of the on-disk cache """
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pt-p300bt', 'merge')
+
+
+def file_digest(path):
+    """ Return the SHA-256 hex digest of the content of a file """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ImageCache(object):
+    """ Two-level (memory and disk) LRU cache of images keyed by content
+
+    The in-memory level holds up to max_items images; the on-disk level
+    stores PNG files and evicts the least recently used ones when their
+    total size exceeds max_bytes. Set directory to None to disable it.
+    """
+    def __init__(self, directory=None, max_items=16, max_bytes=64 << 20):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+
+    def make_key(self, path, *params):
+        """ Build a cache key from the content of the file and the parameters """
+        h = hashlib.sha256(file_digest(path).encode())
+        h.update(repr((CACHE_VERSION,) + params).encode())
+        return h.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def get(self, key):
+        image = self._memory.get(key)
+        if image is not None:
+            self._memory.move_to_end(key)
+            return image
+        if self.directory is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with Image.open(path) as f:
+                image = f.copy()
+            os.utime(path)  # mark as recently used
+        except (OSError, SyntaxError):
+            return None
+        self._remember(key, image)
+        return image
+
+    def put(self, key, image):
+        self._remember(key, image)
+        if self.directory is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            image.save(tmp_path, 'PNG')
+            os.replace(tmp_path, path)
+            self._evict()
+        except OSError:
+            # The disk cache is only an optimization
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _remember(self, key, image):
+        self._memory[key] = image
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.png'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -2,12 +2,36 @@ import sys
 import os
 import re
 import argparse
+import collections
+import csv
+import functools
+import io
+import itertools
+import json
 import serial
-from PIL import Image, ImageDraw, ImageFont, ImageOps, ImageFilter
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFilter
 from pdf2image import convert_from_path
 
-from labelmaker import do_print_job, reset_printer
-    
+from labelmaker import do_print_pages, reset_printer
+from labelmaker_encode import RasterPrefix, RasterStream, split_page
+from labelfont import draw_text, fit_font_size, get_font
+from mergecache import ImageCache, default_cache_dir
+from ptreplay import CaptureFile, is_capture
+from ptstatus import STATUS_TIMEOUT
+from pttiming import TIMER, profiling, timed
+from pttransfer import DEFAULT_FRAME_SIZE
+from ptraster import raster_lines, raster_to_image, threshold, to_raster
+
+HEIGHT_OF_THE_PRINTABLE_AREA = 64  # px: number of vertical pixels of the PT-P300BT printer (9 mm)
+HEIGHT_OF_THE_TAPE = 86  # 64 px / 9 mm * 12 mm (the borders over the printable area will not be printed)
+HEIGHT_OF_THE_IMAGE = 88  # px (can be any value >= HEIGHT_OF_THE_TAPE, but HEIGHT_OF_THE_TAPE + 2 border lines is good)
+H_PADDING = 5  # horizontal padding (left and right)
+PRINT_BORDER = (HEIGHT_OF_THE_IMAGE - HEIGHT_OF_THE_PRINTABLE_AREA) / 2
+RESAMPLING_MARGIN = 4  # px: columns beyond the support of the LANCZOS filter when scaling down
+STRIP_WIDTH = 256  # px: columns rendered at a time with --stream
+MAX_PAGE_LINES = int((499 - 25 - 1) / 0.149)  # raster lines of a page within the maximum print length
+
 
 def set_args():
     """
@@ -84,6 +108,18 @@ def set_args():
         help='With image merge, shift down the image of Y dots.',
         default = 12
     )
+    p.add_argument(
+        '--cache-dir',
+        metavar='DIR_NAME',
+        help='With image merge, directory of the cache of processed images.'
+        ' (Default: a "pt-p300bt" folder in the user cache directory)',
+        default=None
+    )
+    p.add_argument(
+        '--no-cache',
+        help='With image merge, do not cache the processed images.',
+        action='store_true'
+    )
     p.add_argument(
         '-S', '--save',
         metavar='FILE_NAME',
@@ -111,6 +147,12 @@ def set_args():
         default=0,
         type=int
     )
+    p.add_argument(
+        '-w', '--wait',
+        help='Wait for the end of the printing and fail if it does not complete'
+        ' in the expected time.',
+        action='store_true'
+    )
     p.add_argument(
         '-r', '--raw',
         help='Send the image to printer as-is without any pre-processing.',
@@ -121,6 +163,14 @@ def set_args():
         help='Disable compression.',
         action='store_true'
     )
+    p.add_argument(
+        '--frame-size',
+        metavar='BYTES',
+        help='Size of the serial writes of the image data'
+        f' (Default: {DEFAULT_FRAME_SIZE}, about one Bluetooth RFCOMM frame)',
+        type=int,
+        default=DEFAULT_FRAME_SIZE,
+    )
     p.add_argument(
         '--fill-color',
         dest="fill",
@@ -168,25 +218,171 @@ def set_args():
         type=int,
         default=75,
     )
+    p.add_argument(
+        '--scale-factor',
+        help='Supersampling factor of the text rendering: 1 draws the glyphs'
+        ' directly at printer resolution (fastest), 4 renders at 4x and'
+        ' scales down (smoothest). (Default: 4)',
+        type=int,
+        choices=[1, 2, 4],
+        default=4,
+    )
+    p.add_argument(
+        '--glyph-cache',
+        help='Draw the text by blitting cached glyphs, falling back to the full'
+        ' text layout for complex scripts and kerned pairs. Faster with many labels'
+        ' (e.g., --batch).',
+        action='store_true'
+    )
+    p.add_argument(
+        '--stream',
+        help='Render the label in strips, sending each one to the printer as soon'
+        ' as it is ready: the memory used does not grow with the label length.'
+        ' Cannot be used with -S, -s and -c.',
+        action='store_true'
+    )
     p.add_argument(
         '--multiline',
         help='Split text into multiple lines using "|" as separator. Supports up to 3 lines.',
         action='store_true'
     )
+    p.add_argument(
+        '--timing',
+        help='Show the time spent in each processing stage on the standard error.',
+        action='store_true'
+    )
+    p.add_argument(
+        '--timing-format',
+        choices=['summary', 'json'],
+        default='summary',
+        help='Format of --timing: a summary table (default) or JSON lines.'
+    )
+    p.add_argument(
+        '--profile',
+        metavar='FILE_NAME',
+        help='Profile the run with cProfile and write the stats to FILE_NAME.'
+    )
+    p.add_argument(
+        '-B', '--batch',
+        metavar='FILE_NAME',
+        help='Print one label for each record of a CSV or NDJSON file ("-" = stdin),'
+        ' chained in a single print job. Records have a "text" field and optional'
+        ' "font", "align" and "size" (MILLIMETERS) fields overriding the options.'
+        ' TEXT_TO_PRINT is ignored.'
+    )
+    p.add_argument(
+        '-j', '--jobs',
+        metavar='NUMBER',
+        help='With --batch, render the labels in NUMBER worker processes (0 = one per CPU),'
+        ' sending each label to the printer as soon as it is rendered. (Default: 1)',
+        type=int,
+        default=1,
+    )
     return p
 
 
-def process_image(image_path, resize, white_level, target_height):
-    # Determines if the image is a PDF and converts it to PNG if necessary
-    if image_path.lower().endswith('.pdf'):
-        image_path = convert_pdf(image_path)  # Sends image_path to convert_pdf() and returns the output_filename
+BATCH_FIELDS = ('text', 'font', 'align', 'size')
+
+
+def read_batch(p, args):
+    """
+    Read the labels of a batch file (CSV or NDJSON). Return a list of
+    (args, text) tuples, where args includes the per-record overrides.
+    """
+    try:
+        if args.batch == '-':
+            content = sys.stdin.read()
+        else:
+            with open(args.batch, encoding='utf-8') as f:
+                content = f.read()
+    except OSError as e:
+        p.error(f'Cannot read batch file "{args.batch}" - {e}')
+
+    records = []
+    if content.lstrip().startswith('{'):  # NDJSON
+        for number, line in enumerate(content.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                p.error(f'Invalid JSON in batch line {number} - {e}')
+            if not isinstance(record, dict) or 'text' not in record:
+                p.error(f'Missing "text" field in batch line {number}')
+            records.append(record)
+    else:  # CSV, with an optional header line naming the fields
+        rows = [row for row in csv.reader(io.StringIO(content)) if row]
+        fields = BATCH_FIELDS
+        if rows and rows[0][0].strip().lower() == 'text':
+            fields = [field.strip().lower() for field in rows.pop(0)]
+        records = [dict(zip(fields, row)) for row in rows]
+
+    labels = []
+    for number, record in enumerate(records, 1):
+        row_args = argparse.Namespace(**vars(args))
+        if record.get('font'):
+            row_args.fontname = record['font']
+        if record.get('align'):
+            if record['align'] not in ('left', 'center', 'right'):
+                p.error(f'Invalid alignment "{record["align"]}" in batch record {number}')
+            row_args.align = record['align']
+        if record.get('size'):
+            try:
+                row_args.text_size = int(record['size'])
+            except ValueError:
+                p.error(f'Invalid size "{record["size"]}" in batch record {number}')
+        text = str(record['text'])
+        if args.unicode:
+            text = text.encode().decode('unicode_escape')
+        labels.append((row_args, text))
+    if not labels:
+        p.error(f'No labels in batch file "{args.batch}"')
+    return labels
+
+
+def find_content_box(img, white_level):
+    """
+    Return the (left, top, right, bottom) box enclosing the pixels of a
+    greyscale image which are darker than white_level, or None when the
+    content is missing or too thin to be cropped.
+    """
+    # White pixels in grayscale have a value close to 255: map them to 0
+    # and everything else to 255, then let PIL compute the box in C
+    mask = img.point([255 if v < white_level else 0 for v in range(256)])
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    if right - left < 2 or bottom - top < 2:
+        return None
+    return bbox
+
+
+@functools.lru_cache(maxsize=None)
+def get_merge_cache(directory):
+    """ Return the cache of processed merge images, shared by all labels """
+    return ImageCache(directory)
 
-    # Open the image
-    img = Image.open(image_path)
+
+@timed('process_image')
+def process_image(image_path, resize, white_level, target_height, cache=None):
+    # Reuse the result of a previous run on a file with the same content
+    key = None
+    if cache is not None:
+        key = cache.make_key(image_path, resize, white_level, target_height)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    # Determines if the image is a PDF and rasterizes its first page if necessary
+    if image_path.lower().endswith('.pdf'):
+        img = convert_pdf(image_path)
+    else:
+        # Open the image
+        img = Image.open(image_path)
     
     # Convert the image to RGBA to ensure it has an alpha channel
     img = img.convert("RGBA")
-    pixels = img.load()
 
     # Create a new white background image with the same size as the original
     white_background = Image.new("RGBA", img.size, (255, 255, 255, 255))
@@ -199,28 +395,13 @@ def process_image(image_path, resize, white_level, target_height):
     
     # Convert the image to grayscale
     img = img.convert("L")  # "L" mode is for grayscale images
-    
-    # Get image dimensions
-    width, height = img.size
 
-    # Initialize the bounding box coordinates
-    left, top, right, bottom = width, height, 0, 0
-    
-    # Iterate over each pixel to find the bounding box of non-white pixels
-    for y in range(height):
-        for x in range(width):
-            pixel = img.getpixel((x, y))
-            
-            # White pixels in grayscale have a value close to 255
-            if pixel < white_level:  # Consider pixels that are not white
-                left = min(left, x)
-                right = max(right, x)
-                top = min(top, y)
-                bottom = max(bottom, y)
-    
+    # Find the bounding box of non-white pixels
+    bbox = find_content_box(img, white_level)
+
     # Crop the image to the bounding box
-    if right > left and bottom > top:
-        cropped_img = img.crop((left, top, right + 1, bottom + 1))
+    if bbox is not None:
+        cropped_img = img.crop(bbox)
         
         # Get the size of the cropped image
         cropped_width, cropped_height = cropped_img.size
@@ -230,321 +411,549 @@ def process_image(image_path, resize, white_level, target_height):
         new_width = int(target_height * aspect_ratio)
         
         # Resize the image to target height while maintaining aspect ratio
-        return cropped_img.resize(
+        resized_img = cropped_img.resize(
             (int(new_width * resize), int(target_height * resize)),
             Image.Resampling.LANCZOS
         )
+        if cache is not None:
+            cache.put(key, resized_img)
+        return resized_img
     else:
         print("No content detected to crop.")
     return None
 
+@timed('convert_pdf')
 def convert_pdf(filename):
-    # Converts the first page of a PDF to a PNG, returns PNG
-    output_filename = filename.replace('.pdf', '.png')
+    # Converts the first page of a PDF to an image, kept in memory
     images = convert_from_path(filename, dpi=300, first_page=1, last_page=1) # used defaults, 300dpi may even be overkill for labels
-    images[0].save(output_filename, "PNG")
-    return output_filename
+    return images[0]
 
-def main():
-    p = set_args()
-    args = p.parse_args()
-    data = None
-    if args.image is None: # not using the legacy mode
-        height_of_the_printable_area = 64  # px: number of vertical pixels of the PT-P300BT printer (9 mm)
-        height_of_the_tape = 86  # 64 px / 9 mm * 12 mm (the borders over the printable area will not be printed)
-        height_of_the_image = 88  # px (can be any value >= height_of_the_tape, but height_of_the_tape + 2 border lines is good)
-        h_padding = 5  # horizontal padding (left and right)
-
-        # Process text and handle multiline
-        text = " ".join(args.text_to_print)
-        if args.unicode:
-            text = text.encode().decode('unicode_escape')
-        
-        lines = []
-        if args.multiline:
-            lines = [line.strip() for line in text.split('|')]
-            if len(lines) > 3:
-                p.error("Maximum 3 lines supported")
-            if not all(lines):
-                p.error("Empty lines are not allowed")
-        else:
-            lines = [text]
+@timed('fit_text')
+def fit_text(p, args, text):
+    """
+    Split the text in lines and find the font size where they fit the
+    printable area. Return the lines, the font size and the image width.
+    """
+    # Handle multiline
+    lines = []
+    if args.multiline:
+        lines = [line.strip() for line in text.split('|')]
+        if len(lines) > 3:
+            p.error("Maximum 3 lines supported")
+        if not all(lines):
+            p.error("Empty lines are not allowed")
+    else:
+        lines = [text]
 
-        num_lines = len(lines)
-        line_height = height_of_the_printable_area // num_lines
-        print_border = (height_of_the_image - height_of_the_printable_area) / 2
-        
-        # Create a drawing context for the image
-        max_width = 0
-        font_size = 1  # Start with size 1 instead of 0
-        font = None
-        
-        # Calculate target width if text_size is specified
-        target_width = None
-        if args.text_size:
-            # Convert mm to dots based on known ratio: 64 pixels = 9mm
-            dots_per_mm = 64 / 9  # ≈ 7.11 dots/mm
-            target_width = int(args.text_size * dots_per_mm) - h_padding - args.end_margin
-        
-        # Find the maximum font size that fits all lines
-        while True:
-            try:
-                font = ImageFont.truetype(args.fontname, font_size, encoding='utf-8')
-                current_max_width = 0
-                current_max_height = 0
-                
-                # Calculate available height per line based on number of lines
-                if num_lines == 1:
-                    available_height = height_of_the_printable_area
-                elif num_lines == 2:
-                    # For 2 lines: 27 pixels each (42.2%) with 10 pixels (15.6%) gap
-                    available_height = 27  # 64 * 0.422
-                else:  # 3 lines
-                    # For 3 lines: 17 pixels each (26.6%) with 6.5 pixels (10.1%) gaps
-                    available_height = 17  # 64 * 0.266
-                
-                for line in lines:
-                    bbox = font.getbbox(line, anchor="lt")
-                    line_width = bbox[2]
-                    line_height = bbox[3]
-                    current_max_width = max(current_max_width, line_width)
-                    current_max_height = max(current_max_height, line_height)
-                
-                # Check if we've exceeded either height or width constraints
-                if current_max_height > available_height or (target_width and current_max_width > target_width):
-                    font_size -= 1
-                    # Revert to last working font size
-                    font = ImageFont.truetype(args.fontname, font_size, encoding='utf-8')
-                    break
-                else:
-                    font_size += 1
-                    max_width = current_max_width
-                
-            except Exception as e:
-                p.error(f'Cannot load font "{args.fontname}" - {e}')
-
-        # Create the image with the calculated dimensions - using higher resolution for better quality
-        scale_factor = 4  # Create image at 4x resolution then scale down for better quality
-        image = Image.new(
-            "RGB",
-            ((max_width + h_padding * 2 + 1) * scale_factor, height_of_the_image * scale_factor),
-            "white"
+    num_lines = len(lines)
+
+    # Calculate target width if text_size is specified
+    target_width = None
+    if args.text_size:
+        # Convert mm to dots based on known ratio: 64 pixels = 9mm
+        dots_per_mm = 64 / 9  # ≈ 7.11 dots/mm
+        target_width = int(args.text_size * dots_per_mm) - H_PADDING - args.end_margin
+
+    # Calculate available height per line based on number of lines
+    if num_lines == 1:
+        available_height = HEIGHT_OF_THE_PRINTABLE_AREA
+    elif num_lines == 2:
+        # For 2 lines: 27 pixels each (42.2%) with 10 pixels (15.6%) gap
+        available_height = 27  # 64 * 0.422
+    else:  # 3 lines
+        # For 3 lines: 17 pixels each (26.6%) with 6.5 pixels (10.1%) gaps
+        available_height = 17  # 64 * 0.266
+
+    # Find the maximum font size that fits all lines
+    try:
+        font_size, max_width = fit_font_size(
+            args.fontname, tuple(lines), available_height, target_width
         )
-        draw = ImageDraw.Draw(image)
+    except Exception as e:
+        p.error(f'Cannot load font "{args.fontname}" - {e}')
 
-        # Scale up the font size for higher resolution
-        font = ImageFont.truetype(args.fontname, font_size * scale_factor, encoding='utf-8')
+    return lines, font_size, max_width + H_PADDING * 2 + 1
 
-        # Calculate x position based on alignment
-        def get_x_position(line_width):
-            if args.align == 'left':
-                return h_padding * scale_factor
-            elif args.align == 'right':
-                return image.width - (h_padding * scale_factor) - line_width
-            else:  # center
-                return (image.width - line_width) // 2
 
-        # Draw each line of text at higher resolution
-        try:
-            if num_lines == 1:
-                # Single line - center vertically in printable area
-                bbox = font.getbbox(lines[0], anchor="lt")
-                text_height = bbox[3]
-                y_position = (height_of_the_image * scale_factor - text_height) // 2
+def render_text(p, args, text, columns=None):
+    """
+    Render the text alone to an RGB image with the height of the tape.
+    With columns, a (start, end) tuple, only these columns of the image are
+    rendered (e.g. a strip of a long label).
+    """
+    lines, font_size, width = fit_text(p, args, text)
+    num_lines = len(lines)
+    start, end = columns or (0, width)
+
+    # Create the image with the calculated dimensions at --scale-factor times
+    # the printer resolution (1, 2 or 4), scaled down after drawing the text
+    scale_factor = args.scale_factor
+
+    # Only draw the needed columns, plus the ones used by the resampling filter
+    margin = RESAMPLING_MARGIN if scale_factor > 1 else 0
+    left = max(0, start - margin) * scale_factor
+    right = min(width, end + margin) * scale_factor
+    image = Image.new(
+        "RGB",
+        (right - left, HEIGHT_OF_THE_IMAGE * scale_factor),
+        "white"
+    )
+    draw = ImageDraw.Draw(image)
+
+    # Scale up the font size for higher resolution
+    font = get_font(args.fontname, font_size * scale_factor)
+
+    # Calculate x position based on alignment
+    def get_x_position(line_width):
+        if args.align == 'left':
+            return H_PADDING * scale_factor
+        elif args.align == 'right':
+            return width * scale_factor - (H_PADDING * scale_factor) - line_width
+        else:  # center
+            return (width * scale_factor - line_width) // 2
+
+    # Draw a line of text, blitting cached glyphs if requested
+    def draw_line(xy, line):
+        xy = (xy[0] - left, xy[1])
+        stroke_width = args.stroke_width * scale_factor if args.stroke_width else 0
+        if args.glyph_cache:
+            draw_text(
+                image, xy, line, args.fontname, font_size * scale_factor,
+                fill=args.fill,
+                stroke_width=stroke_width,
+                stroke_fill=args.stroke_fill
+            )
+        else:
+            draw.text(
+                xy,
+                line,
+                font=font,
+                fill=args.fill,
+                anchor="lt",
+                stroke_width=stroke_width,
+                stroke_fill=args.stroke_fill
+            )
+
+    # Draw each line of text at higher resolution
+    try:
+        if num_lines == 1:
+            # Single line - center vertically in printable area
+            bbox = font.getbbox(lines[0], anchor="lt")
+            text_height = bbox[3]
+            y_position = (HEIGHT_OF_THE_IMAGE * scale_factor - text_height) // 2
+            x_position = get_x_position(bbox[2])
+            draw_line((x_position, y_position), lines[0])
+        elif num_lines == 2:
+            # Two lines - center the block of text vertically
+            line_height = 27 * scale_factor  # 42.2% of 64
+            gap = 10 * scale_factor        # 15.6% of 64
+            total_height = (2 * line_height) + gap
+            start_y = (HEIGHT_OF_THE_IMAGE * scale_factor - total_height) // 2
+
+            for i, line in enumerate(lines):
+                y_position = start_y + (i * (line_height + gap))
+                bbox = font.getbbox(line, anchor="lt")
                 x_position = get_x_position(bbox[2])
-                draw.text(
-                    (x_position, y_position),
-                    lines[0],
-                    font=font,
-                    fill=args.fill,
-                    anchor="lt",
-                    stroke_width=args.stroke_width * scale_factor if args.stroke_width else 0,
-                    stroke_fill=args.stroke_fill
-                )
-            elif num_lines == 2:
-                # Two lines - center the block of text vertically
-                line_height = 27 * scale_factor  # 42.2% of 64
-                gap = 10 * scale_factor        # 15.6% of 64
-                total_height = (2 * line_height) + gap
-                start_y = (height_of_the_image * scale_factor - total_height) // 2
-                
-                for i, line in enumerate(lines):
-                    y_position = start_y + (i * (line_height + gap))
-                    bbox = font.getbbox(line, anchor="lt")
-                    x_position = get_x_position(bbox[2])
-                    draw.text(
-                        (x_position, y_position),
-                        line,
-                        font=font,
-                        fill=args.fill,
-                        anchor="lt",
-                        stroke_width=args.stroke_width * scale_factor if args.stroke_width else 0,
-                        stroke_fill=args.stroke_fill
-                    )
-            else:  # 3 lines
-                # Three lines - 17 pixels each with 6.5 pixel gaps
-                line_height = 17 * scale_factor  # 26.6% of 64
-                gap = 6.5 * scale_factor       # 10.1% of 64
-                for i, line in enumerate(lines):
-                    y_position = (print_border + (i * (line_height/scale_factor + gap/scale_factor))) * scale_factor
-                    bbox = font.getbbox(line, anchor="lt")
-                    x_position = get_x_position(bbox[2])
-                    draw.text(
-                        (x_position, y_position),
-                        line,
-                        font=font,
-                        fill=args.fill,
-                        anchor="lt",
-                        stroke_width=args.stroke_width * scale_factor if args.stroke_width else 0,
-                        stroke_fill=args.stroke_fill
-                    )
-        except Exception as e:
-            p.error(f"Invalid parameter: {e}")
-
-        # Scale down the image with high-quality resampling
+                draw_line((x_position, y_position), line)
+        else:  # 3 lines
+            # Three lines - 17 pixels each with 6.5 pixel gaps
+            line_height = 17 * scale_factor  # 26.6% of 64
+            gap = 6.5 * scale_factor       # 10.1% of 64
+            for i, line in enumerate(lines):
+                y_position = (PRINT_BORDER + (i * (line_height/scale_factor + gap/scale_factor))) * scale_factor
+                bbox = font.getbbox(line, anchor="lt")
+                x_position = get_x_position(bbox[2])
+                draw_line((x_position, y_position), line)
+    except Exception as e:
+        p.error(f"Invalid parameter: {e}")
+
+    # Scale down the image with high-quality resampling
+    if scale_factor > 1:
         image = image.resize(
-            (max_width + h_padding * 2 + 1, height_of_the_image),
-            Image.Resampling.LANCZOS
+            (end - start, HEIGHT_OF_THE_IMAGE),
+            Image.Resampling.LANCZOS,
+            box=(
+                start * scale_factor - left, 0,
+                end * scale_factor - left, HEIGHT_OF_THE_IMAGE * scale_factor
+            )
         )
 
-        if args.text_size:
-            draw = ImageDraw.Draw(image)
+    return image
 
-        if args.merge:
-            for i in reversed(args.merge):
-                loaded_image = process_image(
-                    i,
-                    args.resize,
-                    white_level=args.white_level,
-                    target_height=height_of_the_printable_area
-                )
-                if not loaded_image:
-                    p.error(f'Invalid image "{i}"')
-                dst = Image.new(
-                    "RGB",
-                    (loaded_image.width + image.width, height_of_the_image),
-                    "white"
-                )
-                dst.paste(loaded_image, (args.x_merge, args.y_merge))
-                dst.paste(image, (loaded_image.width, 0))
-                image = dst
-            # Convert the image to binary
-            draw = ImageDraw.Draw(image)
 
-        if args.lines:
-            # Draw ruler (in)
-            draw.text(
-                (0, 1), "in",
-                anchor="la",
-                fill="magenta"
+def merge_images(p, args, image):
+    """ Prepend the images to merge (-M) to the rendered image """
+    cache = None
+    if not args.no_cache:
+        cache = get_merge_cache(args.cache_dir or default_cache_dir())
+    for i in reversed(args.merge):
+        try:
+            loaded_image = process_image(
+                i,
+                args.resize,
+                white_level=args.white_level,
+                target_height=HEIGHT_OF_THE_PRINTABLE_AREA,
+                cache=cache
             )
-            x = -1
-            i = 0
-            while x < image.width:
-                if x > 0:
-                    draw.line(  # top
-                        (
-                            int(x), print_border - (4 if i % 4 else 9),
-                            int(x), print_border - 2
-                        ),
-                        fill="magenta", width=2
-                    )
-                x += 43.18
-                i += 1
-            # Draw ruler (cm)
-            draw.text(
-                (0, 76), "cm",
-                anchor="la",
-                fill="magenta"
+        except OSError as e:
+            p.error(f'Cannot read image "{i}" - {e}')
+        if not loaded_image:
+            p.error(f'Invalid image "{i}"')
+        dst = Image.new(
+            "RGB",
+            (loaded_image.width + image.width, HEIGHT_OF_THE_IMAGE),
+            "white"
+        )
+        dst.paste(loaded_image, (args.x_merge, args.y_merge))
+        dst.paste(image, (loaded_image.width, 0))
+        image = dst
+    return image
+
+
+def draw_rulers(image, x_offset=0, width=None):
+    """
+    Draw the rulers and the borders of the printable area and of the tape
+    (-l). The image can be the part of a label starting at column x_offset;
+    width is the width of the whole label (default: up to the image end).
+    """
+    if width is None:
+        width = x_offset + image.width
+    draw = ImageDraw.Draw(image)
+    # Draw ruler (in)
+    draw.text(
+        (-x_offset, 1), "in",
+        anchor="la",
+        fill="magenta"
+    )
+    x = -1
+    i = 0
+    while x < width:
+        if x > 0:
+            draw.line(  # top
+                (
+                    int(x) - x_offset, PRINT_BORDER - (4 if i % 4 else 9),
+                    int(x) - x_offset, PRINT_BORDER - 2
+                ),
+                fill="magenta", width=2
             )
-            x = -1
-            i = 0
-            while x < image.width:
-                if x > 0:
-                    draw.line(
-                        (
-                            int(x), height_of_the_image - print_border + 1,
-                            int(x), height_of_the_image - print_border
-                            + (5 if i % 10 else 9)
-                        ),
-                        fill="magenta", width=2
-                    )
-                x += 68
-                i += 1
-            # Draw a dotted horizontal line over the top border and below the bottom border of the printable area
-            for x in range(0, image.width, 5):
-                draw.line(  # top
-                    (x, print_border - 1, x + 1, print_border - 1),
-                    fill="red", width=1
-                )
-                draw.line(
-                    (  # bottom
-                        x, height_of_the_image - print_border,
-                        x + 1, height_of_the_image - print_border
-                    ),
-                    fill="red", width=1
-                )
-            # Draw a cyan line showing the tape borders
-            tape_border = int((height_of_the_image - height_of_the_tape) / 2)
-            if tape_border > 0:
-                draw.line(
-                    (0, tape_border - 1, image.width, tape_border - 1),
-                    fill="cyan", width=1
-                )
-                draw.line(
-                    (
-                        0, height_of_the_image - tape_border,
-                        image.width, height_of_the_image - tape_border
-                    ),
-                    fill="cyan", width=1
-                )
+        x += 43.18
+        i += 1
+    # Draw ruler (cm)
+    draw.text(
+        (-x_offset, 76), "cm",
+        anchor="la",
+        fill="magenta"
+    )
+    x = -1
+    i = 0
+    while x < width:
+        if x > 0:
+            draw.line(
+                (
+                    int(x) - x_offset, HEIGHT_OF_THE_IMAGE - PRINT_BORDER + 1,
+                    int(x) - x_offset, HEIGHT_OF_THE_IMAGE - PRINT_BORDER
+                    + (5 if i % 10 else 9)
+                ),
+                fill="magenta", width=2
+            )
+        x += 68
+        i += 1
+    # Draw a dotted horizontal line over the top border and below the bottom border of the printable area
+    first = max(0, (x_offset + 2) // 5 * 5 - 5)  # First dot over the image
+    for x in range(first, min(width, x_offset + image.width), 5):
+        draw.line(  # top
+            (x - x_offset, PRINT_BORDER - 1, x - x_offset + 1, PRINT_BORDER - 1),
+            fill="red", width=1
+        )
+        draw.line(
+            (  # bottom
+                x - x_offset, HEIGHT_OF_THE_IMAGE - PRINT_BORDER,
+                x - x_offset + 1, HEIGHT_OF_THE_IMAGE - PRINT_BORDER
+            ),
+            fill="red", width=1
+        )
+    # Draw a cyan line showing the tape borders
+    tape_border = int((HEIGHT_OF_THE_IMAGE - HEIGHT_OF_THE_TAPE) / 2)
+    if tape_border > 0:
+        draw.line(
+            (-x_offset, tape_border - 1, width - x_offset, tape_border - 1),
+            fill="cyan", width=1
+        )
+        draw.line(
+            (
+                -x_offset, HEIGHT_OF_THE_IMAGE - tape_border,
+                width - x_offset, HEIGHT_OF_THE_IMAGE - tape_border
+            ),
+            fill="cyan", width=1
+        )
 
-        # Convert to greyscale with enhanced quality - no dithering
-        greyscale = image.convert('L', dither=Image.Dither.NONE)
 
-        # Sharpen the image slightly to enhance edges
-        greyscale = greyscale.filter(ImageFilter.SHARPEN)
+@timed('render_label')
+def render_label(p, args, text):
+    """
+    Render the text (with merged images and rulers, if requested) to an
+    RGB image with the height of the tape.
+    """
+    image = render_text(p, args, text)
+    if args.merge:
+        image = merge_images(p, args, image)
+    if args.lines:
+        draw_rulers(image)
+    return image
 
-        # Rotate and mirror the image
-        rotated_image = ImageOps.invert(
-            greyscale.rotate(-90, expand=True, resample=Image.BICUBIC)
-        )
-        rotated_image = ImageOps.mirror(rotated_image)
-
-        # Direct thresholding for crisp lines
-        bin_image = rotated_image.point(lambda x: 255 if x > args.threshold else 0, '1')
-
-        # Convert to binary format required by printer
-        w, h = bin_image.size
-        padded = Image.new('1', (128, h))
-        x, y = (128 - w) // 2, 0
-        nw, nh = x + w, y + h
-        padded.paste(bin_image, (x, y, nw, nh))
-
-        # Compute tape length and print duration
-        print_length = padded.size[1] * 0.149  # mm
-        print(
-            "Length of the printed tape:",
-            "%.1f" % (print_length / 10),
-            "cm = %.1f" % (print_length / 10 / 2.54),
-            "in, printed in",
-            "%.1f" % (print_length / 20),
-            "sec."
+
+@timed('convert_image')
+def convert_image(args, image):
+    """ Convert the rendered RGB image to the 128 dots wide 1bpp printer raster data """
+    # Convert to greyscale with enhanced quality - no dithering
+    greyscale = image.convert('L', dither=Image.Dither.NONE)
+
+    # Sharpen the image slightly to enhance edges
+    greyscale = greyscale.filter(ImageFilter.SHARPEN)
+
+    # Threshold for crisp lines, then rotate, mirror and center the
+    # image on the print head in a single pass
+    return to_raster(threshold(greyscale, args.threshold))
+
+
+class LabelTemplate(object):
+    """
+    Labels sharing a static part, the merged images (-M) and the rulers
+    (-l), followed by a variable text field. The static part is rendered,
+    converted and encoded once; each label only renders and converts the
+    text field.
+    """
+    # Columns of the static part converted again with each text field: the
+    # sharpen filter of convert_image() uses the neighbours of each pixel
+    CONTEXT = 2
+
+    def __init__(self, p, args):
+        self.args = args
+        static = merge_images(p, args, Image.new("RGB", (0, HEIGHT_OF_THE_IMAGE), "white"))
+        self.width = static.width
+        self.prefix = None
+        if self.width < self.CONTEXT:
+            return
+
+        # The rulers and the sharpen filter of the last static columns
+        # depend on the following ones: convert a slightly wider image and
+        # keep the lines which do not depend on the text field
+        head = Image.new("RGB", (self.width + self.CONTEXT, HEIGHT_OF_THE_IMAGE), "white")
+        head.paste(static, (0, 0))
+        if args.lines:
+            draw_rulers(head)
+        data = convert_image(args, head)
+        self.prefix = RasterPrefix(data[:(self.width - self.CONTEXT + 1) * 16], args.nocomp)
+        self.context = static.crop(
+            (self.width - self.CONTEXT, 0, self.width, HEIGHT_OF_THE_IMAGE)
         )
-        print_length += (25 + 1)  # 2.5 cm of wasted tape before, 1 mm after
-        print(
-            "Length of the used tape (adding header and footer):",
-            "%.1f" % (print_length / 10),
-            "cm = %.1f" % (print_length / 10 / 2.54),
-            "in, printed in",
-            "%.1f" % (print_length / 20),
-            "sec."
+
+    def render(self, p, args, text):
+        """ Return the printer raster data of the label with the given text """
+        if self.prefix is None:  # Static part too small to be reused
+            return convert_image(args, render_label(p, args, text))
+        field = render_text(p, args, text)
+        image = Image.new(
+            "RGB", (self.CONTEXT + field.width, HEIGHT_OF_THE_IMAGE), "white"
         )
+        image.paste(self.context, (0, 0))
+        image.paste(field, (self.CONTEXT, 0))
+        if self.args.lines:
+            draw_rulers(image, x_offset=self.width - self.CONTEXT)
+        # The first context lines are already in the prefix
+        data = convert_image(args, image)
+        return self.prefix.data + data[(self.CONTEXT - 1) * 16:]
+
+
+def render_page(p, args, text, template=None):
+    """ Render a label and convert it to printer raster data """
+    if template is not None:
+        return template.render(p, args, text)
+    return convert_image(args, render_label(p, args, text))
+
+
+def label_lines(p, args, text, template=None):
+    """ Return the raster lines of a label from its text layout, without rendering it """
+    static_width = template.width if template is not None else 0
+    return static_width + fit_text(p, args, text)[2]
+
+
+def check_page_length(p, number, lines):
+    """ Refuse a batch label longer than the maximum print length """
+    if lines > MAX_PAGE_LINES:
+        p.error(f'Label {number} exceeds the print length of 49.9 cm = 19.6 in')
+
+
+# Label template of the worker processes of PageRenderer
+_worker_template = None
+
+
+def _init_worker(template):
+    global _worker_template
+    _worker_template = template
+
+
+def _render_worker(args, text):
+    return render_page(set_args(), args, text, _worker_template)
+
+
+class PageRenderer(object):
+    """
+    Render the labels of a batch in a pool of worker processes, iterating
+    over their raster data in print order as soon as each one is ready.
+    At most `ahead` labels are rendered or waiting to be sent at any time,
+    so the memory used does not grow with the length of the batch.
+    """
+    def __init__(self, p, labels, template=None, jobs=None):
+        self.p = p
+        self.labels = labels
+        self.template = template
+        self.jobs = jobs or os.cpu_count() or 1
+        self.ahead = 2 * self.jobs
+        self.lines = 0  # Raster lines yielded so far
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        with ProcessPoolExecutor(
+                self.jobs, initializer=_init_worker, initargs=(self.template,)
+        ) as pool:
+            labels = iter(self.labels)
+            pending = collections.deque(
+                pool.submit(_render_worker, row_args, text)
+                for row_args, text in itertools.islice(labels, self.ahead)
+            )
+            try:
+                while pending:
+                    data = pending.popleft().result()
+                    for row_args, text in itertools.islice(labels, 1):
+                        pending.append(pool.submit(_render_worker, row_args, text))
+                    self.lines += raster_lines(data)
+                    yield data
+            finally:
+                for future in pending:
+                    future.cancel()
+        print()
+        print(f'{len(self.labels)} labels rendered.')
+        print_tape_length(self.lines)
+
+
+def stream_label(p, args, text, strip_width=STRIP_WIDTH):
+    """
+    Render and convert the label in strips of strip_width columns, like
+    convert_image(render_label()) but without ever building the whole
+    image. Return a RasterStream yielding the raster data of each strip.
+    """
+    static = None
+    if args.merge:
+        static = merge_images(p, args, Image.new("RGB", (0, HEIGHT_OF_THE_IMAGE), "white"))
+    static_width = static.width if static else 0
+    width = static_width + fit_text(p, args, text)[2]
+
+    def strips():
+        for start in range(0, width, strip_width):
+            end = min(start + strip_width, width)
+            # One more column on each side for the sharpen filter
+            left, right = max(0, start - 1), min(width, end + 1)
+            image = Image.new("RGB", (right - left, HEIGHT_OF_THE_IMAGE), "white")
+            if static is not None:
+                image.paste(static, (-left, 0))
+            if right > static_width:
+                columns = (max(left, static_width) - static_width, right - static_width)
+                image.paste(
+                    render_text(p, args, text, columns),
+                    (columns[0] + static_width - left, 0)
+                )
+            if args.lines:
+                draw_rulers(image, left, width)
+            data = convert_image(args, image)
+            yield data[(start - left) * 16:(end - left) * 16]
+
+    return RasterStream(width, strips())
+
+
+def print_tape_length(raster_lines):
+    """ Show the length of the tape and the print duration; return the used length in mm """
+    # Compute tape length and print duration
+    print_length = raster_lines * 0.149  # mm
+    print(
+        "Length of the printed tape:",
+        "%.1f" % (print_length / 10),
+        "cm = %.1f" % (print_length / 10 / 2.54),
+        "in, printed in",
+        "%.1f" % (print_length / 20),
+        "sec."
+    )
+    print_length += (25 + 1)  # 2.5 cm of wasted tape before, 1 mm after
+    print(
+        "Length of the used tape (adding header and footer):",
+        "%.1f" % (print_length / 10),
+        "cm = %.1f" % (print_length / 10 / 2.54),
+        "in, printed in",
+        "%.1f" % (print_length / 20),
+        "sec."
+    )
+
+    return print_length
+
+
+def run(p, args):
+    pages = None
+    prefix = None
+    continuous = False
+    if args.batch:
+        if args.save or args.show or args.show_conv:
+            p.error('Options -S, -s and -c cannot be used with --batch')
+        if args.jobs < 0:
+            p.error('The number of jobs cannot be negative')
+        labels = read_batch(p, args)
+        template = None
+        if args.merge:
+            # Render the merged images and the rulers only once
+            template = LabelTemplate(p, args)
+            prefix = template.prefix
+        if args.jobs == 1:
+            pages = []
+            for number, (row_args, text) in enumerate(labels, 1):
+                data = render_page(p, row_args, text, template)
+                check_page_length(p, number, raster_lines(data))
+                pages.append(data)
+            print(f'{len(pages)} labels rendered.')
+            print_tape_length(sum(len(data) for data in pages) // 16)
+        else:
+            # Check all the labels before sending the first one, as with
+            # a single job (the text layouts are cached)
+            for number, (row_args, text) in enumerate(labels, 1):
+                check_page_length(p, number, label_lines(p, row_args, text, template))
+            # Labels are sent while the following ones are being rendered
+            pages = PageRenderer(p, labels, template, args.jobs)
+    elif args.image is None: # not using the legacy mode
+        # Process text
+        text = " ".join(args.text_to_print)
+        if args.unicode:
+            text = text.encode().decode('unicode_escape')
+
+        if args.stream:
+            if args.save or args.show or args.show_conv:
+                p.error('Options -S, -s and -c cannot be used with --stream')
+            # Sent while it is being rendered
+            data = stream_label(p, args, text)
+            image = None
+        else:
+            image = render_label(p, args, text)
+            data = convert_image(args, image)
+        print_length = print_tape_length(raster_lines(data))
 
         # Check max tape length
         if print_length > 499:
-            print("Print length exceeding 49.9 cm = 19.6 in")
-            quit()
+            # Print chained segments within the maximum length
+            pages = split_page(data, MAX_PAGE_LINES)
+            continuous = True
+            print(
+                "Print length exceeding 49.9 cm = 19.6 in:",
+                f"printing {len(pages)} chained segments."
+            )
 
         # Image save and show
         if args.save:
@@ -557,15 +966,28 @@ def main():
             if not args.show_conv and args.no_print:
                 quit()
         if args.show_conv:
-            padded.show()
+            raster_to_image(data).show()
             if args.no_print:
                 quit()
 
-        data = padded.tobytes()
+        if not continuous:
+            pages = [data]
+
+    # Similar to run() in labelmaker.py
+    from printspool import is_spooler, submit_job
+    if is_spooler(args.comport):
+        assert pages is not None
+        # The spooler receives the size of all the pages first
+        sys.exit(submit_job(
+            args.comport, args, [bytes(data) for data in pages], continuous=continuous
+        ))
 
-    # Similar to main() in labelmaker.py
     try:
-        ser = serial.Serial(args.comport, timeout=5)
+        if is_capture(args.comport):
+            # Write the commands to a file, printed later by ptreplay.py
+            ser = CaptureFile(args.comport)
+        else:
+            ser = serial.Serial(args.comport, timeout=STATUS_TIMEOUT)
     except serial.SerialException:
         p.error(
             'Printer on Bluetooth serial port "'
@@ -576,13 +998,24 @@ def main():
         p.error(e)
 
     try:
-        assert data is not None
-        do_print_job(ser, args, data)
+        assert pages is not None
+        do_print_pages(ser, args, pages, prefix=prefix, continuous=continuous)
     except serial.SerialTimeoutException:
         p.error("Timeout while communicating with printer. Please check connection and try again.")
     finally:
         # Initialize
         reset_printer(ser)
+        ser.close()
+
+def main():
+    p = set_args()
+    args = p.parse_args()
+    try:
+        with profiling(args.profile):
+            run(p, args)
+    finally:
+        if args.timing:
+            TIMER.report(args.timing_format)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Print spooler keeping the Bluetooth serial link to the printer open
+#
+# The spooler owns the serial port and accepts print jobs over a local Unix
+# socket; printlabel.py and labelmaker.py submit their jobs to it when their
+# COM_PORT argument is the path of the spooler socket. Jobs are received and
+# encoded while the previous ones are printing, then printed in the order of
+# the connections. The statuses sent by the printer are decoded as soon as
+# they arrive and logged on the standard error.
+
+import argparse
+import contextlib
+import errno
+import itertools
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+import serial
+
+import ptstatus
+from labelmaker import do_print_pages, reset_printer
+from labelmaker_encode import EncodedPages
+
+# Options of do_print_job() forwarded from the client to the spooler
+JOB_OPTIONS = ('no_print', 'no_feed', 'auto_cut', 'end_margin', 'nocomp', 'frame_size', 'wait')
+
+# Maximum time to receive a job, or between two replies sent to the client,
+# in seconds
+RECEIVE_TIMEOUT = 30
+
+# Maximum size of the raster data of a job, in bytes (over 1 km of tape)
+MAX_JOB_BYTES = 128 * 1024 * 1024
+
+
+def is_spooler(path):
+    """ Check whether path is the socket of a running print spooler """
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def submit_job(path, args, pages, out=sys.stdout, continuous=False):
+    """ Send a print job of one or more pages to the spooler and relay its output
+
+    Returns the exit status of the job (0 on success).
+    """
+    header = {k: getattr(args, k, None) for k in JOB_OPTIONS}
+    header['pages'] = [len(data) for data in pages]
+    header['continuous'] = continuous
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(header).encode() + b'\n')
+        for data in pages:
+            s.sendall(data)
+        with s.makefile('rb') as replies:
+            for line in replies:
+                msg = json.loads(line)
+                if 'out' in msg:
+                    out.write(msg['out'])
+                    out.flush()
+                elif 'exit' in msg:
+                    return msg['exit']
+    print('** The print spooler closed the connection unexpectedly.')
+    return 1
+
+
+class _ClientWriter(object):
+    """ File-like object forwarding the job output to the client """
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def _send(self, msg):
+        try:
+            self.wfile.write(json.dumps(msg).encode() + b'\n')
+            self.wfile.flush()
+        except OSError:
+            pass  # The client went away, keep printing anyway
+
+    def write(self, s):
+        if s:
+            self._send({'out': s})
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def finish(self, code):
+        self._send({'exit': code})
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        header, pages, line = None, None, b''
+        try:
+            # A client that stalls must not hold up the following jobs
+            self.request.settimeout(RECEIVE_TIMEOUT)
+            line = self.rfile.readline()
+            if line:
+                header = json.loads(line)
+                sizes = header['pages']
+                if (not isinstance(sizes, list)
+                        or not all(type(size) is int and size >= 0 for size in sizes)
+                        or sum(sizes) > MAX_JOB_BYTES):
+                    raise ValueError('invalid page sizes')
+                pages = [self.rfile.read(size) for size in sizes]
+                if [len(data) for data in pages] != sizes:
+                    raise ValueError('incomplete pages')
+                # Encode now, while the printer may still be busy
+                pages = EncodedPages(pages, header.get('nocomp')).encode_all()
+        except Exception as e:
+            pages = None
+            print(f'** Invalid print job: {e}', file=sys.stderr)
+        finally:
+            # Always take the turn of the job, so that the next ones follow
+            with self.server.printer_turn(self.request):
+                out = _ClientWriter(self.wfile)
+                if pages is not None:
+                    self.server.run_job(header, pages, out)
+                elif line:
+                    out.write('** The print spooler received an invalid print job.\n')
+                    out.finish(1)
+
+
+# socketserver only has UnixStreamServer on the platforms with Unix sockets:
+# keep this module importable elsewhere, where main() refuses to start
+_UnixStreamServer = getattr(socketserver, 'UnixStreamServer', object)
+
+
+class PrintSpooler(socketserver.ThreadingMixIn, _UnixStreamServer):
+    """ Serve print jobs over a single serial session
+
+    Each connection is received and encoded in its own thread; the jobs
+    are printed one at a time, in the order of the connections.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, comport):
+        self.comport = comport
+        self.ser = None
+        self.monitor = None
+        self.printed_by = None  # time.monotonic() by which the last job is printed
+        self._tickets = {}
+        self._next_ticket = itertools.count()
+        self._serving = 0
+        self._turn = threading.Condition()
+        if is_spooler(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(socket_path)
+                except ConnectionRefusedError:
+                    os.remove(socket_path)  # Stale socket of a previous run
+                else:
+                    raise FileExistsError(errno.EADDRINUSE, 'A print spooler is already running')
+        super().__init__(socket_path, _JobHandler)
+
+    def process_request(self, request, client_address):
+        # Called by the accepting thread: number the jobs in order of arrival
+        with self._turn:
+            self._tickets[request] = next(self._next_ticket)
+        super().process_request(request, client_address)
+
+    @contextlib.contextmanager
+    def printer_turn(self, request):
+        """ Wait for the turn of the job received on request to use the printer """
+        with self._turn:
+            ticket = self._tickets.pop(request)
+            self._turn.wait_for(lambda: self._serving == ticket)
+        try:
+            yield
+        finally:
+            with self._turn:
+                self._serving += 1
+                self._turn.notify_all()
+
+    def open_serial(self):
+        """ Return the serial port, as seen through the status monitor """
+        if self.ser is None:
+            self.ser = serial.Serial(self.comport, timeout=ptstatus.STATUS_TIMEOUT)
+            self.monitor = ptstatus.StatusMonitor(self.ser)
+            self.monitor.subscribe(self.log_event, ptstatus.PhaseChanged,
+                                   ptstatus.PrintingCompleted, ptstatus.ErrorReported,
+                                   ptstatus.PowerChanged, ptstatus.NotificationReceived)
+            self.monitor.start()
+            # Flush, initialize and enter raster mode once per session
+            reset_printer(self.monitor)
+        return self.monitor
+
+    def close_serial(self):
+        if self.ser is not None:
+            # Each step is attempted even if the previous one failed, e.g.
+            # on a port that went away
+            with contextlib.suppress(Exception):
+                reset_printer(self.ser)
+            with contextlib.suppress(Exception):
+                self.monitor.stop()
+            with contextlib.suppress(Exception):
+                self.ser.close()
+            self.ser = None
+            self.monitor = None
+
+    def log_event(self, event):
+        """ Log the statuses sent by the printer, e.g. at the end of printing """
+        if isinstance(event, ptstatus.PhaseChanged):
+            message = f'Phase: {ptstatus.describe_code(event.phase, ptstatus.PHASES)}'
+        elif isinstance(event, ptstatus.PrintingCompleted):
+            message = 'Printing completed.'
+        elif isinstance(event, ptstatus.ErrorReported):
+            message = f'** Printer error: {", ".join(event.errors)}'
+        elif isinstance(event, ptstatus.PowerChanged):
+            message = f'Power: {ptstatus.describe_code(event.power, ptstatus.POWER)}'
+        else:
+            message = f'Notification: {ptstatus.describe_code(event.notification, ptstatus.NOTIFICATIONS)}'
+        print(message, file=sys.stderr)
+
+    def ready_timeout(self):
+        """ Return how long to wait for the end of the printing of the
+        previous job, from its length """
+        if self.printed_by is None:
+            return ptstatus.READY_TIMEOUT
+        return max(self.printed_by - time.monotonic(), 0) + ptstatus.PRINT_TIME_MARGIN
+
+    def run_job(self, header, pages, out):
+        args = argparse.Namespace(**{k: header.get(k) for k in JOB_OPTIONS})
+        code = 0
+        try:
+            with contextlib.redirect_stdout(out):
+                ser = self.open_serial()
+                # Drop unsolicited status messages of the previous job
+                ser.reset_input_buffer()
+                ready_timeout, self.printed_by = self.ready_timeout(), None
+                self.printed_by = do_print_pages(
+                    ser, args, pages, reset=False, continuous=bool(header.get('continuous')),
+                    ready_timeout=ready_timeout
+                )
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except serial.SerialException as e:
+            out.write(f'** Printer on "{self.comport}" is unavailable or unreachable: {e}\n')
+            self.close_serial()  # Reconnect on next job
+            code = 1
+        except Exception as e:
+            out.write(f'** Print job failed: {e}\n')
+            # Leave the printer in a known state for the next job
+            if self.monitor is not None:
+                with contextlib.suppress(Exception):
+                    reset_printer(self.monitor)
+            code = 1
+        lines = sum(len(data) for data, _, _ in pages) // 16
+        print(f'Job of {len(pages)} page(s), {lines} lines completed with status {code}.', file=sys.stderr)
+        out.finish(code)
+
+    def server_close(self):
+        super().server_close()
+        self.close_serial()
+        with contextlib.suppress(OSError):
+            os.remove(self.server_address)
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('comport', metavar='COM_PORT', help='Printer COM port.')
+    p.add_argument('socket', metavar='SOCKET_PATH',
+                   help='Path of the Unix socket to create for the clients.')
+    return p, p.parse_args()
+
+
+def main():
+    p, args = parse_args()
+    if not hasattr(socket, 'AF_UNIX'):
+        p.error('Unix sockets are not supported on this platform.')
+    try:
+        spooler = PrintSpooler(args.socket, args.comport)
+    except OSError as e:
+        p.error(f'Cannot create socket "{args.socket}" - {e}')
+    try:
+        try:
+            spooler.open_serial()
+        except serial.SerialException:
+            p.error(
+                'Printer on Bluetooth serial port "'
+                + args.comport
+                + '" is unavailable or unreachable.'
+            )
+        print(f'Spooling jobs from "{args.socket}" to "{args.comport}".', file=sys.stderr)
+        spooler.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spooler.server_close()
+
+
+if __name__ == '__main__':
+    main()
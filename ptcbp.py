@@ -3,8 +3,10 @@
 # Simple PTCBP parser
 
 import io
+import os
 import struct
 import enum
+import functools
 from collections import namedtuple
 from typing import BinaryIO, Optional, Union
 
@@ -227,3 +229,149 @@ def serialize_data(data, compress='none', use_data2=False):
     else:
         mnemonic = 'data'
     return Opcode(op_mnemonic=mnemonic, data=Data(data, compress=compress)).serialize_as_bytes()
+
+# Bulk raster encoder
+RASTER_LINE_SIZE = 16  # 128 dots @ 1bpp
+
+# Number of distinct encoded raster lines kept in memory
+RASTER_CACHE_SIZE = 4096
+
+_DATA_HEADER = struct.Struct('<cH')
+
+@functools.lru_cache(maxsize=RASTER_CACHE_SIZE)
+def _encode_line(line: bytes, compress: str) -> bytes:
+    payload = COMPRESSIONS_TABLE[compress][0](line)
+    return _DATA_HEADER.pack(MNEMONICS['data'][0], len(payload)) + payload
+
+def raster_cache_info():
+    """ Return the hits, misses, maxsize and currsize of the raster line cache """
+    return _encode_line.cache_info()
+
+def iter_raster(data, compress='rle', line_size=RASTER_LINE_SIZE):
+    """ Yield the data/zerofill command of each raster line of a 1bpp buffer
+
+    Equivalent to calling serialize_control('zerofill') or
+    serialize_data(line, compress) per line, without building the
+    intermediate Opcode and Data objects. Compressed lines are memoized,
+    as labels repeat the same lines (padding, glyph stems, rulers).
+    """
+    if compress not in COMPRESSIONS_TABLE:
+        raise ValueError(f'Unknown compression type {compress}')
+    data = bytes(data)
+    zerofill = MNEMONICS['zerofill'][0]
+    zero_line = bytes(line_size)
+
+    if compress == 'none':
+        pack_header = _DATA_HEADER.pack
+        data_op = MNEMONICS['data'][0]
+        for i in range(0, len(data), line_size):
+            line = data[i : i + line_size]
+            if line == zero_line:
+                yield zerofill
+            else:
+                yield pack_header(data_op, len(line)) + line
+    else:
+        for i in range(0, len(data), line_size):
+            line = data[i : i + line_size]
+            if line == zero_line:
+                yield zerofill
+            else:
+                yield _encode_line(line, compress)
+
+def serialize_raster(data, compress='rle', line_size=RASTER_LINE_SIZE) -> bytes:
+    """ Return the complete raster transfer command stream of a 1bpp buffer """
+    buf = bytearray()
+    for command in iter_raster(data, compress, line_size):
+        buf += command
+    return bytes(buf)
+
+# Buffer parser
+_PARAM_SCHEMAS = {}
+
+def _param_schema(fmt: str) -> struct.Struct:
+    schema = _PARAM_SCHEMAS.get(fmt)
+    if schema is None:
+        schema = _PARAM_SCHEMAS[fmt] = struct.Struct(fmt)
+    return schema
+
+class Command(object):
+    """ Command parsed by iter_commands()
+
+    payload is a memoryview slice of the parsed buffer (not a copy), or
+    None for the commands without data; data() decompresses it on demand.
+    position is the offset of the command in the buffer.
+    """
+    __slots__ = ('op', 'params', 'payload', 'position')
+
+    def __init__(self, op: bytes, params: Optional[tuple], payload: Optional[memoryview], position: int) -> None:
+        self.op = op
+        self.params = params
+        self.payload = payload
+        self.position = position
+
+    @property
+    def op_mnemonic(self):
+        return OPS_FLAT[self.op][1]
+
+    def data(self, compress: str='none') -> Optional[bytes]:
+        if self.payload is None:
+            return None
+        if compress not in COMPRESSIONS_TABLE:
+            raise ValueError(f'Unknown compression type {compress}')
+        return COMPRESSIONS_TABLE[compress][1](bytes(self.payload))
+
+    def to_opcode(self, data_compress: str='none') -> Opcode:
+        """ Return the Opcode that Opcode.deserialize() would have built """
+        data = None
+        if self.payload is not None:
+            data = Data(bytes(self.payload), compress=data_compress, decompress=data_compress)
+        return Opcode(op=bytearray(self.op), params=self.params, data=data)
+
+def iter_commands(buffer, start: int=0):
+    """ Yield the commands of a PTCBP stream held in a buffer (bytes,
+    bytearray, memoryview or mmap) as Command objects, without copying
+
+    Raises the same errors, at the same positions, as parsing the buffer
+    with successive calls of Opcode.deserialize().
+    """
+    view = memoryview(buffer).cast('B')
+    end = len(view)
+    pos = start
+    while pos < end:
+        position = pos
+        level = OPS
+        while True:
+            if pos >= end:
+                raise IOError('Unexpected end of stream')
+            byte = view[pos]
+            pos += 1
+            entry = level.get(byte)
+            if entry is None:
+                raise ValueError(f'Unknown byte 0x{byte:02x} at position {pos:d}')
+            if not isinstance(entry, dict):
+                break
+            level = entry
+        params = None
+        if entry[2] is not None:
+            schema = _param_schema(entry[2])
+            if pos + schema.size > end:
+                raise IOError('Unexpected end of stream')
+            params = schema.unpack_from(view, pos)
+            pos += schema.size
+        payload = None
+        if entry[3] is not None:
+            data_len = entry[3][0](params)
+            if pos + data_len > end:
+                raise IOError('Unexpected end of stream')
+            payload = view[pos:pos + data_len]
+            pos += data_len
+        yield Command(entry[0], params, payload, position)
+
+def map_file(path):
+    """ Return a read-only mmap of a file (or b'' if it is empty), to be
+    parsed with iter_commands() """
+    import mmap
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# PT-P300BT emulator on a pseudo-terminal
+#
+# The emulator creates a pseudo-terminal and prints the path of its slave
+# side, which can be used as COM_PORT of printlabel.py, labelmaker.py and
+# printspool.py. It parses the PTCBP commands, answers the status requests,
+# decodes the raster lines of each page into a bitmap and simulates the
+# bandwidth and the latency of the Bluetooth link and the print speed.
+
+import argparse
+import contextlib
+import os
+import sys
+import threading
+import time
+
+import ptcbp
+import ptstatus
+from ptstatus import FEED_LENGTH, LINE_LENGTH, PRINT_SPEED
+from ptraster import HEAD_DOTS
+
+# Phases reported in the status (phase_type, phase)
+PHASE_READY = (0x00, 0x0000)
+PHASE_PRINTING = (0x01, 0x0000)
+
+# Status types
+STATUS_REPLY = 0x00
+STATUS_PRINTING_COMPLETED = 0x01
+STATUS_PHASE_CHANGE = 0x06
+
+
+class ThrottledReader(object):
+    """ Read from a file descriptor at most bandwidth bytes per second
+
+    Provides the read() and tell() methods used by ptcbp.Opcode.deserialize.
+    Data are read in chunks of chunk_size bytes (about one RFCOMM frame);
+    while the reader sleeps, the pty buffer fills up and blocks the writer
+    as the Bluetooth link would.
+    """
+    def __init__(self, fd, bandwidth=None, chunk_size=990):
+        self.fd = fd
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.position = 0
+        self._buffer = b''
+        self._next_read = time.monotonic()
+
+    def _fill(self):
+        if self.bandwidth:
+            delay = self._next_read - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            chunk = os.read(self.fd, self.chunk_size)
+        except OSError:  # EIO: no process has the slave side open
+            chunk = b''
+        if self.bandwidth:
+            self._next_read = max(self._next_read, time.monotonic()) + len(chunk) / self.bandwidth
+        self._buffer += chunk
+        return len(chunk)
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            if not self._fill():
+                break
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+
+class PrinterEmulator(object):
+    """ Emulate the PTCBP raster interface of a PT-P300BT on a file descriptor
+
+    Decoded pages are passed to on_page(number, data, lines) as 1bpp raster
+    data, HEAD_DOTS dots per line, like the output of ptraster.to_raster().
+    """
+    def __init__(self, fd, bandwidth=None, latency=0.0, print_speed=PRINT_SPEED,
+                 tape_width=12, tape_type=ptcbp.MediaType.laminated, on_page=None,
+                 log=sys.stderr):
+        self.fd = fd
+        self.reader = ThrottledReader(fd, bandwidth)
+        self.latency = latency
+        self.print_speed = print_speed
+        self.tape_width = tape_width
+        self.tape_type = tape_type
+        self.on_page = on_page
+        self.log = log
+        self.pages = 0
+        self._write_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._phase = PHASE_READY
+        self._print_lines = 0
+        self.reset()
+
+    def reset(self):
+        self.compression = 'none'
+        self.length_px = None
+        self.page = bytearray()
+        self._page_start = None
+
+    def status(self, status_type=STATUS_REPLY):
+        """ Return the 32 bytes status register """
+        with self._state_lock:
+            phase_type, phase = self._phase
+        status = ptstatus.make_status(self.tape_width, self.tape_type, status_type,
+                                      phase_type, phase)
+        return bytes(status)
+
+    def _send(self, data):
+        with self._write_lock:
+            os.write(self.fd, data)
+
+    def reply(self, data, delay=0.0):
+        """ Send data to the host after the link latency """
+        delay += self.latency
+        if delay > 0:
+            timer = threading.Timer(delay, self._send, (data,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._send(data)
+
+    def _printed(self):
+        with self._state_lock:
+            self._phase = PHASE_READY
+        self._send(self.status(STATUS_PRINTING_COMPLETED))
+        self._send(self.status(STATUS_PHASE_CHANGE))
+
+    def end_page(self, last):
+        """ Handle print_page (last=False) and print (last=True) """
+        lines = len(self.page) // (HEAD_DOTS // 8)
+        self.pages += 1
+        seconds = time.monotonic() - self._page_start if self._page_start else 0.0
+        self.log.write(
+            f'Page {self.pages}: {lines} lines, {self.reader.position} bytes received in total'
+            f' ({seconds:.2f} sec. of raster data)\n'
+        )
+        if self.length_px is not None and self.length_px != lines:
+            self.log.write(f'** Page {self.pages}: {self.length_px} lines announced, {lines} received\n')
+        if self.on_page is not None:
+            self.on_page(self.pages, bytes(self.page), lines)
+        self._print_lines += lines
+        self.page = bytearray()
+        self._page_start = None
+        if last:
+            # Print the job, then notify the end of printing
+            length = self._print_lines * LINE_LENGTH + FEED_LENGTH
+            self._print_lines = 0
+            with self._state_lock:
+                self._phase = PHASE_PRINTING
+            self.reply(self.status(STATUS_PHASE_CHANGE))
+            timer = threading.Timer(self.latency + length / self.print_speed, self._printed)
+            timer.daemon = True
+            timer.start()
+
+    def handle(self, op):
+        mnemonic = op.op_mnemonic
+        if mnemonic == 'reset':
+            self.reset()
+        elif mnemonic == 'get_status':
+            self.reply(self.status())
+        elif mnemonic == 'set_print_parameters':
+            params = ptcbp.PrintParameters(*op.params)
+            self.length_px = params.length_px
+        elif mnemonic == 'compression':
+            self.compression = 'rle' if op.params[0] == ptcbp.CompressionType.rle else 'none'
+        elif mnemonic in ('data', 'data2', 'zerofill'):
+            if self._page_start is None:
+                self._page_start = time.monotonic()
+            if mnemonic == 'zerofill':
+                self.page += bytes(HEAD_DOTS // 8)
+            else:
+                self.page += op.data.getvalue_raw()
+        elif mnemonic in ('print_page', 'print'):
+            self.end_page(mnemonic == 'print')
+
+    def run(self):
+        """ Process the commands received from the host, forever """
+        while True:
+            try:
+                op = ptcbp.Opcode.deserialize(self.reader, self.compression)
+            except (ValueError, IOError) as e:
+                self.log.write(f'** Invalid PTCBP stream: {e}\n')
+                continue
+            if op is None:  # No client: wait for the next one
+                time.sleep(0.1)
+                continue
+            self.handle(op)
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('-b', '--bandwidth', metavar='BYTES',
+                   help='Bytes per second received from the host (default: unlimited).'
+                   ' The Bluetooth serial link of the printer transfers a few tens of KB/s.',
+                   type=int, default=None)
+    p.add_argument('-L', '--latency', metavar='SECONDS',
+                   help='Delay of the replies to the host (default: 0).',
+                   type=float, default=0.0)
+    p.add_argument('--print-speed', metavar='MM_PER_S',
+                   help=f'Print speed in mm per second (default: {PRINT_SPEED}).',
+                   type=float, default=PRINT_SPEED)
+    p.add_argument('--tape-width', metavar='MM',
+                   help='Width of the loaded tape (default: 12).',
+                   type=int, default=12)
+    p.add_argument('-o', '--output', metavar='DIR_NAME',
+                   help='Save each received page to a "page-NNN.png" image in DIR_NAME.')
+    p.add_argument('-l', '--link', metavar='PATH',
+                   help='Create a symbolic link to the pseudo-terminal at PATH.')
+    return p, p.parse_args()
+
+
+def main():
+    p, args = parse_args()
+    try:
+        import pty
+        import tty
+    except ImportError:
+        p.error('Pseudo-terminals are not supported on this platform.')
+
+    on_page = None
+    if args.output:
+        from ptraster import raster_to_image
+        os.makedirs(args.output, exist_ok=True)
+
+        def save_page(number, data, lines):
+            if lines:
+                raster_to_image(data).save(os.path.join(args.output, f'page-{number:03d}.png'))
+        on_page = save_page
+
+    master, slave = pty.openpty()
+    # Keep the slave side open, so that the clients can come and go
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    if args.link:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(args.link)
+        os.symlink(path, args.link)
+    print(path, flush=True)
+
+    emulator = PrinterEmulator(master, bandwidth=args.bandwidth, latency=args.latency,
+                               print_speed=args.print_speed, tape_width=args.tape_width,
+                               on_page=on_page)
+    try:
+        emulator.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link:
+            with contextlib.suppress(OSError):
+                os.remove(args.link)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Conversion of label images to the 1bpp raster of the print head
+
+import numpy as np
+
+import ptcbp
+
+# Number of dots of the print head (128 dots @ 1bpp = 16 bytes per line)
+HEAD_DOTS = 128
+
+
+def threshold(greyscale, level):
+    """ Return the dots to print of a greyscale image, as a boolean array
+
+    A pixel is printed when its inverted value (255 - pixel) is above level.
+    """
+    return np.asarray(greyscale) < 255 - level
+
+
+def to_raster(dots, transform=True, padding=True):
+    """ Pack a boolean array of dots (True = black) in image orientation
+    to 1bpp raster data
+
+    With transform, the image rows (the height of the tape) become the dots
+    of each raster line and the image columns become raster lines, which
+    is a rotation by 90 degrees plus a mirror, i.e. a transposition. With
+    padding, each line is centered on the HEAD_DOTS dots of the print head.
+    """
+    if transform:
+        dots = dots.T
+    if padding:
+        lines, width = dots.shape
+        x = (HEAD_DOTS - width) // 2
+        padded = np.zeros((lines, HEAD_DOTS), dtype=bool)
+        if x >= 0:
+            padded[:, x:x + width] = dots
+        else:  # Too wide, keep the central dots
+            padded[:, :] = dots[:, -x:-x + HEAD_DOTS]
+        dots = padded
+    return np.packbits(dots, axis=1).tobytes()
+
+
+def raster_lines(data):
+    """ Return the number of raster lines of 1bpp data padded to the head width """
+    return len(data) // (HEAD_DOTS // 8)
+
+
+def raster_to_image(data):
+    """ Return the padded raster data as a PIL '1' image, one row per line """
+    from PIL import Image
+    return Image.frombytes('1', (HEAD_DOTS, raster_lines(data)), data)
+
+
+def raster_to_dots(data):
+    """ Return 1bpp raster data as a boolean array of dots (True = black),
+    one row per line: the inverse of to_raster(dots, transform=False) """
+    dots = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    return dots.reshape(-1, HEAD_DOTS).astype(bool)
+
+
+def decode_pages(buffer):
+    """ Decode the raster lines of a PTCBP stream (bytes, memoryview or mmap)
+
+    Return the 1bpp raster data of each page, as produced by to_raster():
+    pages end with a print_page or print command; the lines following the
+    last one, if any, form a last page. Raises ValueError if the stream is
+    invalid or a line does not have the width of the print head.
+    """
+    line_size = HEAD_DOTS // 8
+    blank_line = bytes(line_size)
+    pages = []
+    page = bytearray()
+    compress = 'none'
+    for command in ptcbp.iter_commands(buffer):
+        mnemonic = command.op_mnemonic
+        if mnemonic == 'reset':
+            compress = 'none'
+            page = bytearray()
+        elif mnemonic == 'compression':
+            compress = 'rle' if command.params[0] == ptcbp.CompressionType.rle else 'none'
+        elif mnemonic in ('data', 'data2'):
+            line = command.data(compress)
+            if len(line) != line_size:
+                raise ValueError(f'Raster line of {len(line)} bytes at position {command.position:d}')
+            page += line
+        elif mnemonic == 'zerofill':
+            page += blank_line
+        elif mnemonic in ('print_page', 'print'):
+            pages.append(bytes(page))
+            page = bytearray()
+    if page:
+        pages.append(bytes(page))
+    return pages
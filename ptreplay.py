@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# Capture of print jobs to .ptcbp files and their replay
+#
+# Passing a file name ending in ".ptcbp" in place of COM_PORT makes
+# printlabel.py and labelmaker.py write the commands they would send to the
+# printer (initialization, configuration, raster data and print) to the file
+# instead. ptreplay.py sends the captured jobs later, without rendering them
+# again: it only depends on pyserial, not on PIL.
+
+import argparse
+import sys
+import time
+
+import ptcbp
+import ptstatus
+import serial
+from pttiming import TIMER, stage
+from pttransfer import DEFAULT_FRAME_SIZE, FrameWriter
+
+CAPTURE_SUFFIX = '.ptcbp'
+
+# Width of the tape reported to the captured jobs, in mm
+CAPTURE_TAPE_WIDTH = 12
+
+
+def is_capture(path):
+    """ Check whether path names a capture file """
+    return path.lower().endswith(CAPTURE_SUFFIX)
+
+
+class CaptureFile(object):
+    """ Serial port writing the commands sent to the printer to a file
+
+    Reads return the status of a ready printer loaded with a tape_width mm
+    laminated tape, so that labelmaker.do_print_pages() runs unchanged.
+    """
+    def __init__(self, path, tape_width=CAPTURE_TAPE_WIDTH):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.status = bytes(ptstatus.make_status(tape_width))
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def read(self, size=1):
+        return (self.status * (size // len(self.status) + 1))[:size]
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        if not self.file.closed:
+            print(f'=> Job captured to "{self.path}" ({self.file.tell()} bytes).')
+            self.file.close()
+
+
+class Capture(object):
+    """ Captured job, checked with ptcbp.iter_commands()
+
+    replies holds the (position, end, mnemonic) of the commands the printer
+    replies to (get_status and print); tape_widths the tape widths of the
+    set_print_parameters commands; lines the number of raster lines.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.buffer = ptcbp.map_file(path)
+        self.replies = []
+        self.tape_widths = set()
+        self.lines = 0
+        for command in ptcbp.iter_commands(self.buffer):
+            mnemonic = command.op_mnemonic
+            if mnemonic in ('data', 'data2', 'zerofill'):
+                self.lines += 1
+            elif mnemonic in ('get_status', 'print'):
+                self.replies.append((command.position, command.position + len(command.op), mnemonic))
+            elif mnemonic == 'set_print_parameters':
+                self.tape_widths.add(ptcbp.PrintParameters(*command.params).width_mm)
+
+    def __len__(self):
+        return len(self.buffer)
+
+
+def replay(ser, capture, frame_size=DEFAULT_FRAME_SIZE, ready_timeout=ptstatus.READY_TIMEOUT):
+    """ Send a captured job to the printer
+
+    The status requests of the capture are replaced by a wait for the
+    printer to be ready, up to ready_timeout seconds (see
+    ptstatus.wait_for_ready()). Returns the time.monotonic() by which the
+    printing must be completed, or None if the capture does not print.
+    """
+    view = memoryview(capture.buffer)
+    writer = FrameWriter(ser, frame_size)
+    deadline = None
+    start = 0
+    try:
+        for position, end, mnemonic in capture.replies + [(len(view), len(view), None)]:
+            with stage('send'):
+                writer.write(view[start:position])
+                writer.flush()
+            start = end
+            if mnemonic == 'get_status':
+                status = ptstatus.wait_for_ready(ser, ready_timeout)
+                if status is None:
+                    print('** Printer does not reply. Refusing to continue.')
+                    sys.exit(1)
+                ptstatus.print_status(status)
+                if not ptstatus.is_ready(status):
+                    print('** Printer indicates that it is not ready. Refusing to continue.')
+                    sys.exit(1)
+                if capture.tape_widths - {status.tape_width}:
+                    widths = ', '.join(f'{width}mm' for width in sorted(capture.tape_widths))
+                    print(f'** The job was captured for a {widths} tape. Refusing to continue.')
+                    sys.exit(1)
+            elif mnemonic == 'print':
+                status = ptstatus.start_printing(ser)
+                if status is None:
+                    print('** Printer did not acknowledge the print command.')
+                    sys.exit(1)
+                deadline = ptstatus.print_deadline(capture.lines)
+                ptstatus.print_status(status)
+    finally:
+        view.release()
+    print(f'=> Sent {writer.stats.bytes} bytes.')
+    return deadline
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('comport', metavar='COM_PORT', help='Printer COM port.')
+    p.add_argument('captures', metavar='FILE_NAME', nargs='+',
+                   help=f'Captured print jobs ({CAPTURE_SUFFIX} files), printed in order.')
+    p.add_argument('--frame-size', metavar='BYTES',
+                   help=f'Size of the serial writes (default: {DEFAULT_FRAME_SIZE}).',
+                   type=int, default=DEFAULT_FRAME_SIZE)
+    p.add_argument('--timing', action='store_true',
+                   help='Show the time spent in each stage on the standard error.')
+    p.add_argument('--timing-format', choices=['summary', 'json'], default='summary',
+                   help='Format of --timing: a summary table (default) or JSON lines.')
+    return p, p.parse_args()
+
+
+def main():
+    p, args = parse_args()
+    if args.frame_size < 1:
+        p.error('The frame size must be positive')
+
+    # Check all the jobs before printing the first one
+    captures = []
+    for path in args.captures:
+        try:
+            captures.append(Capture(path))
+        except (OSError, ValueError) as e:
+            p.error(f'Invalid capture "{path}" - {e}')
+
+    try:
+        ser = serial.Serial(args.comport, timeout=ptstatus.STATUS_TIMEOUT)
+    except serial.SerialException:
+        p.error(f'Printer on Bluetooth serial port "{args.comport}" is unavailable or unreachable.')
+
+    try:
+        printed_by = None
+        for number, capture in enumerate(captures, 1):
+            print(f'=> Printing "{capture.path}" ({number}/{len(captures)}, {len(capture)} bytes)...')
+            # Wait for the previous job as long as its length requires
+            ready_timeout = ptstatus.READY_TIMEOUT
+            if printed_by is not None:
+                ready_timeout = max(printed_by - time.monotonic(), 0) + ptstatus.PRINT_TIME_MARGIN
+            printed_by = replay(ser, capture, args.frame_size, ready_timeout)
+        print('=> All done.')
+    except serial.SerialTimeoutException:
+        p.error('Timeout while communicating with printer. Please check connection and try again.')
+    finally:
+        if args.timing:
+            TIMER.report(args.timing_format)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,39 @@
 import ctypes
 import sys
 import contextlib
+import threading
+import time
 import ptcbp
 import serial
+from collections import namedtuple
+from pttiming import timed
+
+# Maximum time to wait for the end of the printing of a previous job of
+# unknown length, in seconds
+READY_TIMEOUT = 60
+
+# Timeout of the reads of the serial port, in seconds: the waits below are
+# made of reads of this length, checking their deadline in between
+STATUS_TIMEOUT = 0.5
+
+# Maximum time to wait for the reply to a command, in seconds
+REPLY_TIMEOUT = 3
+
+# Time without notification after which the status is queried again while
+# waiting for the end of the printing, in seconds
+STATUS_POLL_INTERVAL = 2
+
+# Print speed of the PT-P300BT, in mm/s
+PRINT_SPEED = 20
+
+# Length of a raster line, in mm (180 DPI)
+LINE_LENGTH = 0.149
+
+# Tape fed before and after the printable area, in mm
+FEED_LENGTH = 25 + 1
+
+# Time added to the estimated print time before giving up, in seconds
+PRINT_TIME_MARGIN = 5
 
 POWER = {
     0: 'Battery full',
@@ -131,6 +162,7 @@ NOTIFICATIONS = {
 }
 
 class StatusRegister(ctypes.BigEndianStructure):
+    _pack_ = 1  # 32 bytes, hw_settings is not aligned
     _fields_ = (
         ('magic', ctypes.c_char * 4),
         ('model', ctypes.c_uint8),
@@ -222,6 +254,264 @@ def unpack_status(bytes_):
     ctypes.memmove(ctypes.addressof(status), bytes_, ctypes.sizeof(status))
     return status
 
+def make_status(tape_width=12, tape_type=0x01, status_type=0x00, phase_type=0x00, phase=0x0000, err=0x0000):
+    """ Build the status of a PT-P300BT loaded with a black on white tape """
+    return StatusRegister(
+        magic=b'\x80\x20B0',
+        model=0x72,  # PT-P300BT
+        country=0x30,
+        _power=0,  # Battery full
+        err=err,
+        tape_width=tape_width,
+        tape_type=tape_type,
+        colors=0,
+        fonts=0,
+        mode=0,
+        density=0,
+        tape_length=0,  # Continuous tape
+        status_type=status_type,
+        phase_type=phase_type,
+        phase=phase,
+        notification=0x00,
+        expansion_area=0,
+        tape_bgcolor=0x01,  # White
+        tape_fgcolor=0x08,  # Black
+        hw_settings=0,
+    )
+
+def is_ready(status):
+    return status.err == 0x0000 and status.phase_type == 0x00 and status.phase == 0x0000
+
+def print_time(raster_lines):
+    """ Estimate the time to print raster_lines lines, feed included, in seconds """
+    return (raster_lines * LINE_LENGTH + FEED_LENGTH) / PRINT_SPEED
+
+def print_deadline(raster_lines):
+    """ Return the time.monotonic() by which printing raster_lines lines
+    started now must be completed """
+    return time.monotonic() + print_time(raster_lines) + PRINT_TIME_MARGIN
+
+def read_status(ser, deadline):
+    """ Read the next status, waiting until deadline (a time.monotonic());
+    return None if no complete status was received by then """
+    data = b''
+    while len(data) < 32:
+        data += ser.read(32 - len(data))
+        if len(data) < 32 and time.monotonic() >= deadline:
+            return None
+    return unpack_status(data)
+
+def query_status(ser):
+    """ Request the status; return it, or None if the printer does not reply """
+    ser.write(ptcbp.serialize_control('get_status'))
+    return read_status(ser, time.monotonic() + REPLY_TIMEOUT)
+
+def wait_while_printing(ser, status, deadline):
+    """ Wait for the printer to stop printing, following its notifications
+    (printing completed, phase change) until deadline
+
+    Returns the first status that is ready or reports an error, the last
+    status received if the deadline passed, or None if the printer stopped
+    replying.
+    """
+    while status.err == 0x0000 and status.phase_type != 0x00 and time.monotonic() < deadline:
+        poll = min(deadline, time.monotonic() + STATUS_POLL_INTERVAL)
+        if isinstance(ser, StatusMonitor):
+            # Woken up by the status that ends the wait, the ones in
+            # between are not needed
+            reply = ser.wait_for(lambda status: status.err != 0x0000 or status.phase_type == 0x00,
+                                 max(poll - time.monotonic(), 0))
+            ser.reset_input_buffer()
+        else:
+            reply = read_status(ser, poll)
+        if reply is not None:
+            status = reply
+        elif time.monotonic() < deadline:
+            # No notification for a while (or a truncated status): ask again
+            ser.reset_input_buffer()
+            status = query_status(ser)
+            if status is None:
+                return None
+    return status
+
+@timed('wait_for_ready')
+def wait_for_ready(ser, timeout=READY_TIMEOUT):
+    """ Query the printer status, waiting up to timeout seconds while the
+    printer is still printing (e.g. the previous job); return the status,
+    or None if the printer does not reply """
+    status = query_status(ser)
+    if status is not None and status.err == 0x0000 and status.phase_type != 0x00:
+        print('=> Waiting for the printer to finish printing...')
+        status = wait_while_printing(ser, status, time.monotonic() + timeout)
+    return status
+
+@timed('print')
+def start_printing(ser):
+    """ Send the print command; return the status acknowledging it, or None
+    if the printer does not reply """
+    # Drop the late notifications of a previous job: the next status is
+    # the one of this print
+    ser.reset_input_buffer()
+    ser.write(ptcbp.serialize_control('print'))
+    return read_status(ser, time.monotonic() + REPLY_TIMEOUT)
+
+@timed('wait_for_printed')
+def wait_for_printed(ser, status, deadline):
+    """ Wait for the end of the printing acknowledged by status, until
+    deadline (see print_deadline()); return the status as in
+    wait_while_printing() """
+    if status.err == 0x0000 and status.phase_type == 0x00 and status.status_type != 0x01:
+        # The acknowledgement can precede the phase change to printing
+        status = read_status(ser, min(deadline, time.monotonic() + REPLY_TIMEOUT)) or status
+    return wait_while_printing(ser, status, deadline)
+
+# First bytes of each status
+STATUS_MAGIC = b'\x80\x20B0'
+
+# Events published by StatusMonitor; status is the StatusRegister, phase a
+# key of PHASES, errors the descriptions of the ERR_FLAGS set, power a key
+# of POWER and notification a key of NOTIFICATIONS
+StatusReceived = namedtuple('StatusReceived', ('status',))
+PhaseChanged = namedtuple('PhaseChanged', ('status', 'phase'))
+PrintingCompleted = namedtuple('PrintingCompleted', ('status',))
+ErrorReported = namedtuple('ErrorReported', ('status', 'errors'))
+PowerChanged = namedtuple('PowerChanged', ('status', 'power'))
+NotificationReceived = namedtuple('NotificationReceived', ('status', 'notification'))
+
+def status_events(status, previous=None):
+    """ Return the events of a status, given the previous one (if any) """
+    events = [StatusReceived(status)]
+    phase = status.phase_type << 16 | status.phase
+    if previous is None:
+        changed = status.status_type == 0x06
+    else:
+        changed = phase != previous.phase_type << 16 | previous.phase
+    # The end of the printing comes before the phase change it causes
+    if status.status_type == 0x01:
+        events.append(PrintingCompleted(status))
+    if changed:
+        events.append(PhaseChanged(status, phase))
+    if status.err and (status.status_type == 0x02 or previous is None or status.err != previous.err):
+        errors = [ERR_FLAGS.get(bit, f'bit{bit}') for bit in range(16) if status.err >> bit & 1]
+        events.append(ErrorReported(status, errors))
+    if previous is None or status._power != previous._power:
+        events.append(PowerChanged(status, status._power))
+    if status.status_type == 0x05 or status.notification:
+        events.append(NotificationReceived(status, status.notification))
+    return events
+
+class StatusMonitor(object):
+    """ Read the statuses sent by the printer in a background thread
+
+    Each status is decoded as soon as it is received and published as
+    events (see status_events()) to the callbacks registered with
+    subscribe(), which are called from the monitor thread. The monitor owns
+    the reading side of the serial port: it provides the write(), read()
+    and reset_input_buffer() methods used by labelmaker.do_print_pages(),
+    read() returning the received statuses in order.
+    """
+    def __init__(self, ser):
+        self.ser = ser
+        self.timeout = ser.timeout
+        self.status = None  # Last received status
+        self.error = None  # Exception that stopped the monitor
+        self._subscribers = []
+        self._received = bytearray()  # Statuses not read yet
+        self._changed = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='StatusMonitor', daemon=True)
+
+    def subscribe(self, callback, *event_types):
+        """ Call callback(event) for each event of the given types (default: all) """
+        self._subscribers.append((callback, event_types))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping = True
+        cancel_read = getattr(self.ser, 'cancel_read', None)
+        if cancel_read is not None:
+            cancel_read()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        buffer = bytearray()
+        try:
+            while not self._stopping:
+                buffer += self.ser.read(self.ser.in_waiting or 1)
+                while True:
+                    start = buffer.find(STATUS_MAGIC)
+                    if start < 0:
+                        # Keep a possible beginning of the magic
+                        del buffer[:max(len(buffer) - len(STATUS_MAGIC) + 1, 0)]
+                        break
+                    if len(buffer) < start + 32:
+                        del buffer[:start]
+                        break
+                    self._publish(bytes(buffer[start:start + 32]))
+                    del buffer[:start + 32]
+        except Exception as e:
+            if not self._stopping:
+                self.error = e
+        finally:
+            with self._changed:
+                self._stopping = True
+                self._changed.notify_all()
+
+    def _publish(self, frame):
+        status = unpack_status(frame)
+        with self._changed:
+            events = status_events(status, self.status)
+            self.status = status
+            self._received += frame
+            self._changed.notify_all()
+        for event in events:
+            for callback, event_types in self._subscribers:
+                if event_types and not isinstance(event, event_types):
+                    continue
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f'** Status callback failed: {e}', file=sys.stderr)
+
+    def wait_for(self, predicate, timeout=None):
+        """ Wait until predicate(status) is true for the last received status;
+        return the status, or None on timeout """
+        with self._changed:
+            if self._changed.wait_for(lambda: self._stopping or (
+                    self.status is not None and predicate(self.status)), timeout):
+                if self.status is not None and predicate(self.status):
+                    return self.status
+            if self.error is not None:
+                raise self.error
+        return None
+
+    def write(self, data):
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        """ Return the next size bytes of the received statuses, waiting up
+        to the timeout of the serial port """
+        with self._changed:
+            self._changed.wait_for(lambda: self._stopping or len(self._received) >= size, self.timeout)
+            if self.error is not None:
+                raise self.error
+            data = bytes(self._received[:size])
+            del self._received[:size]
+        return data
+
+    def reset_input_buffer(self):
+        with self._changed:
+            self._received.clear()
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print(f'Usage: {sys.argv[0]} <COM port>')
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Stage timers and profiling of printlabel and labelmaker
+
+import contextlib
+import cProfile
+import functools
+import json
+import sys
+import time
+
+
+class StageTimer(object):
+    """ Accumulate the time spent in named stages (which can be nested) """
+    def __init__(self):
+        self.stages = {}  # name -> [seconds, calls], in order of first use
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += elapsed
+            totals[1] += 1
+
+    def reset(self):
+        self.stages.clear()
+
+    def report(self, mode='summary', out=sys.stderr):
+        """ Write the totals as a summary table or as JSON lines """
+        if mode == 'json':
+            for name, (seconds, calls) in self.stages.items():
+                out.write(json.dumps({'stage': name, 'seconds': seconds, 'calls': calls}) + '\n')
+            return
+        if not self.stages:
+            return
+        out.write('=> Time per stage (stages can include other ones):\n')
+        width = max(len(name) for name in self.stages)
+        for name, (seconds, calls) in self.stages.items():
+            out.write(f'  {name:<{width}} {seconds:9.3f} sec. ({calls} calls)\n')
+        out.flush()
+
+
+# Timer shared by the modules of a run
+TIMER = StageTimer()
+
+stage = TIMER.stage
+
+
+def timed(name):
+    """ Decorator timing each call of the function as the given stage """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def profiling(path):
+    """ Profile the enclosed code with cProfile if path is set, dumping the
+    stats to path (to be read with pstats or e.g. snakeviz) """
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f'Profile written to "{path}".', file=sys.stderr)
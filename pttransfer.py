@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Buffered transmission of PTCBP commands over the serial link
+
+import time
+
+from pttiming import stage
+
+# Payload of a single RFCOMM frame on most Bluetooth stacks (the negotiated
+# MTU is usually between 990 and 1013 bytes); raster lines are coalesced into
+# writes of this size instead of one write per 3-19 bytes command.
+DEFAULT_FRAME_SIZE = 990
+
+# Minimum time between two progress reports, in seconds
+PROGRESS_INTERVAL = 0.1
+
+
+class Throughput(object):
+    """ Count the bytes and raster lines sent and the elapsed time """
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+        self.start = None
+        self.end = None
+
+    def begin(self):
+        if self.start is None:
+            self.start = time.perf_counter()
+
+    def stop(self):
+        self.end = time.perf_counter()
+
+    @property
+    def seconds(self):
+        if self.start is None:
+            return 0.0
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    @property
+    def lines_per_second(self):
+        return self.lines / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (f'{self.bytes} bytes, {self.lines} lines in {self.seconds:.2f} sec.'
+                f' ({self.bytes_per_second:.0f} bytes/s, {self.lines_per_second:.0f} lines/s)')
+
+
+class FrameWriter(object):
+    """ Coalesce raster commands into frames of frame_size bytes
+
+    progress, if set, is called with the list of line commands sent since
+    its previous call, at most once every progress_interval seconds and
+    once more by flush().
+    """
+    def __init__(self, ser, frame_size=DEFAULT_FRAME_SIZE, progress=None,
+                 progress_interval=PROGRESS_INTERVAL):
+        if frame_size < 1:
+            raise ValueError('Frame size must be positive')
+        self.ser = ser
+        self.frame_size = frame_size
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stats = Throughput()
+        self._buffer = bytearray()
+        self._pending = []
+        self._last_report = time.monotonic()
+
+    def write(self, command):
+        """ Queue a command, sending all the complete frames """
+        self.stats.begin()
+        self._buffer += command
+        if len(self._buffer) >= self.frame_size:
+            self._send_frames()
+
+    def write_line(self, command):
+        """ Queue the command transferring a raster line """
+        self.stats.lines += 1
+        if self.progress is not None:
+            self._pending.append(command)
+        self.write(command)
+
+    def flush(self):
+        """ Send the queued data, including the last partial frame """
+        if self._buffer:
+            self._write(self._buffer)
+            self._buffer = bytearray()
+        self.stats.stop()
+        self._report()
+
+    def _send_frames(self):
+        size = len(self._buffer) - len(self._buffer) % self.frame_size
+        view = memoryview(self._buffer)
+        for i in range(0, size, self.frame_size):
+            self._write(view[i:i + self.frame_size])
+        view.release()
+        del self._buffer[:size]
+        if time.monotonic() - self._last_report >= self.progress_interval:
+            self._report()
+
+    def _write(self, frame):
+        with stage('serial_write'):
+            self.ser.write(frame)
+        self.stats.bytes += len(frame)
+
+    def _report(self):
+        self._last_report = time.monotonic()
+        if self.progress is not None and self._pending:
+            pending, self._pending = self._pending, []
+            self.progress(pending)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Golden image regression checks of the label processing pipeline
+#
+# Each label of the corpus is printed to a capture file (see ptreplay.py),
+# the captured command stream is decoded back to raster pages with
+# ptraster.decode_pages() and compared with the golden images of the goldens
+# directory, rendered with the font of the fonts directory (Source Code Pro,
+# SIL Open Font License). The golden images also depend on the Pillow and
+# FreeType versions, which are recorded with them: a change meant to alter
+# the dots regenerates them with --update and commits them with the change.
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import PIL
+from PIL import Image, features
+
+import numpy as np
+
+from benchmark import git_revision
+from printlabel import run, set_args
+from ptraster import decode_pages, raster_to_dots, raster_to_image
+
+# Labels: name -> (TEXT_TO_PRINT, extra options, golden image name); BATCH
+# is replaced by a CSV file of BATCH_RECORDS. Labels sharing a golden image
+# are printed through different paths and must give the same dots.
+CORPUS = {
+    'single': ('Hello World', [], 'single'),
+    'single_nocomp': ('Hello World', ['-C'], 'single'),
+    'multiline': ('Line one|Line two|Line three', ['--multiline'], 'multiline'),
+    'text_size': ('lorem ipsum dolor', ['--text-size', '40'], 'text_size'),
+    'stroke': ('Bold', ['--stroke-width', '1'], 'stroke'),
+    'long': ('Long label text ' * 6, ['-l'], 'long'),
+    'long_stream': ('Long label text ' * 6, ['-l', '--stream'], 'long'),
+    'chained': ('Chained label segments ' * 16, [], 'chained'),
+    'batch': ('', ['-B', 'BATCH'], 'batch'),
+    'batch_jobs': ('', ['-B', 'BATCH', '-j', '2'], 'batch'),
+}
+
+BATCH_RECORDS = ('text,align', 'RACK-42 U17,', 'A-1,left', 'Lorem Ipsum,right')
+
+# File of the golden image directory describing how the images were made
+REFERENCE_FILE = 'reference.json'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FONT = os.path.join(HERE, 'fonts', 'SourceCodePro-Regular.ttf')
+DEFAULT_GOLDEN_DIR = os.path.join(HERE, 'goldens')
+
+
+def capture_label(p, argv, path):
+    """ Print a label to a capture file with printlabel options; return the
+    captured command stream """
+    args = p.parse_args([path] + argv)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run(p, args)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def golden_path(golden_dir, golden, page):
+    return os.path.join(golden_dir, f'{golden}-{page:03d}.png')
+
+
+def read_goldens(golden_dir, golden):
+    """ Return the raster data of the pages of a golden image set """
+    pages = []
+    while os.path.exists(golden_path(golden_dir, golden, len(pages) + 1)):
+        with Image.open(golden_path(golden_dir, golden, len(pages) + 1)) as image:
+            pages.append(image.convert('1').tobytes())
+    return pages
+
+
+def rendering_environment(font):
+    """ Describe what the rendered dots depend on besides the code """
+    with open(font, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {
+        'font': os.path.basename(font),
+        'font_sha256': digest,
+        'pillow': PIL.__version__,
+        'freetype': features.version('freetype2'),
+    }
+
+
+def read_reference(p, golden_dir, environment):
+    """ Check that the golden images exist and were made with the same
+    font; return their description """
+    try:
+        with open(os.path.join(golden_dir, REFERENCE_FILE), encoding='utf-8') as f:
+            reference = json.load(f)
+    except (OSError, ValueError):
+        p.error(f'No golden images in "{golden_dir}": generate them with --update'
+                ' (see README.md)')
+    if reference.get('font_sha256') != environment['font_sha256']:
+        p.error(f'The golden images were rendered with another font ({reference.get("font")}):'
+                ' use the same font file or generate them again with --update')
+    for component in ('pillow', 'freetype'):
+        if reference.get(component) != environment[component]:
+            print(f'** Warning: the golden images were rendered with {component}'
+                  f' {reference.get(component)}, not {environment[component]}:'
+                  ' the glyphs can differ.')
+    return reference
+
+
+def compare(pages, goldens):
+    """ Describe the differences between decoded pages and golden pages,
+    or return None if they are the same """
+    if len(pages) != len(goldens):
+        return f'{len(pages)} pages instead of {len(goldens)}'
+    differences = []
+    for number, (page, golden) in enumerate(zip(pages, goldens), 1):
+        if page == golden:
+            continue
+        if len(page) != len(golden):
+            differences.append(f'page {number}: {len(page) // 16} lines instead of {len(golden) // 16}')
+            continue
+        dots = np.count_nonzero(raster_to_dots(page) != raster_to_dots(golden))
+        differences.append(f'page {number}: {dots} dots differ')
+    return '; '.join(differences) or None
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('labels', metavar='LABEL', nargs='*',
+                   help='Labels to check (default: all). Available: ' + ', '.join(CORPUS))
+    p.add_argument('--font', default=DEFAULT_FONT,
+                   help='Font file of the labels, the same as for the golden images'
+                   ' (default: fonts/SourceCodePro-Regular.ttf).')
+    p.add_argument('--golden-dir', metavar='DIR_NAME', default=DEFAULT_GOLDEN_DIR,
+                   help='Directory of the golden images (default: goldens).')
+    p.add_argument('--update', action='store_true',
+                   help='Write the decoded pages as the new golden images.')
+    return p, p.parse_args()
+
+
+def main():
+    p, args = parse_args()
+    for name in args.labels:
+        if name not in CORPUS:
+            p.error(f'Unknown label "{name}"')
+    if not os.path.isfile(args.font):
+        p.error(f'Font file "{args.font}" not found')
+    environment = rendering_environment(args.font)
+    if args.update:
+        os.makedirs(args.golden_dir, exist_ok=True)
+        with open(os.path.join(args.golden_dir, REFERENCE_FILE), 'w', encoding='utf-8') as f:
+            json.dump(dict(revision=git_revision(), **environment), f, indent=2)
+    else:
+        reference = read_reference(p, args.golden_dir, environment)
+        print(f'Golden images of revision {reference.get("revision")}, rendered with'
+              f' {reference.get("font")}.')
+    label_parser = set_args()
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        batch = os.path.join(tmp, 'batch.csv')
+        with open(batch, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(BATCH_RECORDS) + '\n')
+        updated = set()
+        for name in args.labels or CORPUS:
+            text, options, golden = CORPUS[name]
+            argv = [args.font, text] + [batch if o == 'BATCH' else o for o in options]
+            start = time.perf_counter()
+            stream = capture_label(label_parser, argv, os.path.join(tmp, f'{name}.ptcbp'))
+            render = time.perf_counter() - start
+            start = time.perf_counter()
+            pages = decode_pages(stream)
+            if args.update and golden not in updated:
+                number = 0
+                for number, page in enumerate(pages, 1):
+                    raster_to_image(page).save(golden_path(args.golden_dir, golden, number))
+                # Drop the pages of a previous golden image set
+                while os.path.exists(golden_path(args.golden_dir, golden, number + 1)):
+                    number += 1
+                    os.remove(golden_path(args.golden_dir, golden, number))
+                updated.add(golden)
+                result = 'updated'
+            else:
+                goldens = read_goldens(args.golden_dir, golden)
+                if not goldens:
+                    result = f'FAILED (no golden image "{golden}")'
+                else:
+                    difference = compare(pages, goldens)
+                    result = f'FAILED ({difference})' if difference else 'ok'
+                if result != 'ok':
+                    failures += 1
+            check = time.perf_counter() - start
+            print(f'{name}: {result} ({len(pages)} pages, {len(stream)} bytes;'
+                  f' rendered in {render * 1000:.1f} ms, checked in {check * 1000:.1f} ms)')
+    if failures:
+        print(f'{failures} labels differ from the golden images.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class ImportTest(unittest.TestCase):
+    def test_without_unix_sockets(self):
+        """ printlabel.py and the spooler module load where socket has no
+        AF_UNIX (Windows), and no COM port is taken for a spooler """
+        code = (
+            'import socket; del socket.AF_UNIX; '
+            'import printlabel, labelmaker, printspool; '
+            'assert not printspool.is_spooler(printspool.__file__)'
+        )
+        subprocess.run([sys.executable, '-c', code], cwd=HERE, check=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import regression
+
+
+class GoldenImageTest(unittest.TestCase):
+    def test_corpus(self):
+        """ The corpus of regression.py gives the dots of the golden images """
+        with open(os.path.join(regression.DEFAULT_GOLDEN_DIR, regression.REFERENCE_FILE)) as f:
+            reference = json.load(f)
+        environment = regression.rendering_environment(regression.DEFAULT_FONT)
+        for component in ('pillow', 'freetype'):
+            if reference[component] != environment[component]:
+                self.skipTest(f'golden images rendered with {component} {reference[component]}')
+        result = subprocess.run(
+            [sys.executable, 'regression.py'], cwd=regression.HERE, capture_output=True, text=True
+        )
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()